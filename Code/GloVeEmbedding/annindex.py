@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from atomicwrite import atomic_write
+
+# Increment when the arrays stored by ANNIndex.save change.
+ANN_INDEX_FORMAT_VERSION = 1
+
+
+@dataclass
+class ANNIndex:
+    """
+    Approximate nearest neighbour index over word vectors, by cosine
+    similarity, using an inverted file: the vectors are partitioned into
+    lists by k-means, and a query is only compared to the vectors in the
+    nprobe lists with the closest centroids, which are then ranked exactly.
+    A query therefore scans about nprobe / num_lists of the vocabulary,
+    plus the centroids.
+    :param vectors: The L2-normalized float32 vectors, ordered by list.
+    :param ids: The row of each vector in the vectors the index was built
+    from.
+    :param centroids: The normalized centroid of each list.
+    :param list_offsets: The vectors of list l are
+    vectors[list_offsets[l]:list_offsets[l + 1]].
+    :param tokens: The token of each row the index was built from, if any.
+    :param nprobe: The number of lists searched by default.
+    :param source_fingerprint: Identifies the vectors and tokens the index
+    was built from, see was_built_from.
+    """
+    vectors: np.ndarray
+    ids: np.ndarray
+    centroids: np.ndarray
+    list_offsets: np.ndarray
+    tokens: np.ndarray | None = None
+    nprobe: int = 8
+    source_fingerprint: str | None = None
+    _token2row: dict[str, int] = field(init=False, repr=False)
+    _positions: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._token2row = {} if self.tokens is None else {
+            token: row for row, token in enumerate(self.tokens.tolist())
+        }
+        # The position in self.vectors of each row.
+        self._positions = np.empty_like(self.ids)
+        self._positions[self.ids] = np.arange(len(self.ids))
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            tokens: list[str] | None = None,
+            num_lists: int | None = None,
+            nprobe: int = 8,
+            num_iterations: int = 10,
+            sample_size: int = 256,
+            seed: int | None = None
+    ) -> ANNIndex:
+        """
+        Builds an index over the rows of vectors.
+        :param vectors: An (n, d) array, e.g. weight + weight_tilde of a
+        trained GloVe model.
+        :param tokens: The token of each row, to query by word.
+        :param num_lists: Number of lists to partition the vectors into.
+        Defaults to about the square root of n.
+        :param nprobe: See ANNIndex.
+        :param num_iterations: Number of k-means iterations.
+        :param sample_size: The centroids are trained on at most this many
+        vectors per list, then every vector is assigned to its closest one.
+        :param seed: Seed for the k-means initialization and sampling.
+        :return:
+        """
+        source_fingerprint = _get_fingerprint(vectors, tokens)
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(len(vectors))))
+        num_lists = min(num_lists, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > sample_size * num_lists:
+            sample = vectors[rng.choice(
+                len(vectors),
+                sample_size * num_lists,
+                replace=False
+            )]
+        centroids = _spherical_kmeans(sample, num_lists, num_iterations, rng)
+
+        assignments = _assign(vectors, centroids)
+        ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(assignments, minlength=num_lists),
+            out=list_offsets[1:]
+        )
+        return cls(
+            vectors=vectors[ids],
+            ids=ids,
+            centroids=centroids,
+            list_offsets=list_offsets,
+            tokens=None if tokens is None else np.asarray(tokens, dtype=str),
+            nprobe=nprobe,
+            source_fingerprint=source_fingerprint
+        )
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    # Returns True if the index was built from these vectors and tokens, so
+    # that a saved index can be told apart from one of an older model.
+    def was_built_from(
+            self,
+            vectors: np.ndarray,
+            tokens: list[str] | None = None
+    ) -> bool:
+        return self.source_fingerprint == _get_fingerprint(vectors, tokens)
+
+    def search(
+            self,
+            queries: np.ndarray,
+            k: int = 10,
+            nprobe: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds approximately the k rows most similar to each query.
+        :param queries: A (q, d) array of query vectors, or a single vector.
+        :param k: Number of neighbours to return for each query.
+        :param nprobe: Number of lists to search, self.nprobe by default.
+        :return: A (q, k) array of the rows of the neighbours, most similar
+        first, and a (q, k) array of their cosine similarities. If fewer
+        than k vectors are searched, the rest are -1 and -inf.
+        """
+        queries = _normalize(np.atleast_2d(queries).astype(np.float32))
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        probed = _top_k(queries @ self.centroids.T, nprobe)
+
+        neighbours = np.full((len(queries), k), -1, dtype=np.int64)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for query_index, (query, lists) in enumerate(zip(queries, probed)):
+            candidates = np.concatenate([
+                np.arange(self.list_offsets[l], self.list_offsets[l + 1])
+                for l in lists
+            ])
+            scores = self.vectors[candidates] @ query
+            best = _top_k(scores[None], min(k, len(candidates)))[0]
+            neighbours[query_index, :len(best)] = self.ids[candidates[best]]
+            similarities[query_index, :len(best)] = scores[best]
+        return neighbours, similarities
+
+    def search_exact(
+            self,
+            queries: np.ndarray,
+            k: int = 10
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows most similar to each query by comparing it to every
+        vector. Returns the same as search.
+        """
+        queries = _normalize(np.atleast_2d(queries).astype(np.float32))
+        scores = queries @ self.vectors.T
+        best = _top_k(scores, min(k, len(self.vectors)))
+        return self.ids[best], np.take_along_axis(scores, best, axis=1)
+
+    def most_similar(
+            self,
+            token: str,
+            k: int = 10,
+            nprobe: int | None = None
+    ) -> list[tuple[str, float]]:
+        """
+        Approximate equivalent of KeyedVectors.similar_by_word.
+        :return: The k tokens most similar to token, other than itself,
+        with their cosine similarities.
+        """
+        if self.tokens is None:
+            raise ValueError("The index was built without tokens.")
+        row = self._token2row.get(token)
+        if row is None:
+            raise KeyError(f"Token {token!r} is not in the index.")
+        query = self.vectors[self._positions[row]]
+        neighbours, similarities = self.search(query, k + 1, nprobe)
+        return [
+            (str(self.tokens[neighbour]), float(similarity))
+            for neighbour, similarity in zip(neighbours[0], similarities[0])
+            if neighbour != row and neighbour >= 0
+        ][:k]
+
+    def recall(
+            self,
+            queries: np.ndarray,
+            k: int = 10,
+            nprobe: int | None = None
+    ) -> float:
+        """
+        Measures how well search approximates search_exact.
+        :return: The fraction of the exact k nearest neighbours of the
+        queries that search also returns.
+        """
+        approximate, _ = self.search(queries, k, nprobe)
+        exact, _ = self.search_exact(queries, k)
+        found = sum(
+            len(np.intersect1d(a, e)) for a, e in zip(approximate, exact)
+        )
+        return found / exact.size
+
+    def save(self, filepath: str) -> None:
+        """
+        Saves the index as an uncompressed .npz file, with atomic_write.
+        :param filepath: Path of the file, which should end in ".npz".
+        :return:
+        """
+        arrays = dict(
+            format_version=np.array(ANN_INDEX_FORMAT_VERSION),
+            vectors=self.vectors,
+            ids=self.ids,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            nprobe=np.array(self.nprobe)
+        )
+        if self.tokens is not None:
+            arrays["tokens"] = self.tokens
+        if self.source_fingerprint is not None:
+            arrays["source_fingerprint"] = np.array(self.source_fingerprint)
+        with atomic_write(filepath) as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, filepath: str) -> ANNIndex:
+        with np.load(filepath) as arrays:
+            format_version = int(arrays["format_version"])
+            if format_version != ANN_INDEX_FORMAT_VERSION:
+                raise ValueError(
+                    f"Unsupported ANN index format version {format_version}."
+                )
+            return cls(
+                vectors=arrays["vectors"],
+                ids=arrays["ids"],
+                centroids=arrays["centroids"],
+                list_offsets=arrays["list_offsets"],
+                tokens=arrays["tokens"] if "tokens" in arrays else None,
+                nprobe=int(arrays["nprobe"]),
+                source_fingerprint=str(arrays["source_fingerprint"])
+                if "source_fingerprint" in arrays else None
+            )
+
+
+# Hash of the shape and values of vectors, as float32, and of tokens.
+def _get_fingerprint(
+        vectors: np.ndarray,
+        tokens: list[str] | None = None
+) -> str:
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    digest = hashlib.sha256(str(vectors.shape).encode("utf-8"))
+    digest.update(vectors.tobytes())
+    if tokens is not None:
+        digest.update("\n".join(tokens).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(vectors.dtype).tiny)
+
+
+# Returns the columns of the k largest scores in each row, largest first.
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+    return np.take_along_axis(best, order, axis=1)
+
+
+# Returns the index of the closest centroid to each vector, in blocks so
+# the similarities of every vector to every centroid are never all held in
+# memory at once.
+def _assign(
+        vectors: np.ndarray,
+        centroids: np.ndarray,
+        block_size: int = 65536
+) -> np.ndarray:
+    return np.concatenate([
+        np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), block_size)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+# K-means on normalized vectors by cosine similarity, with centroids kept
+# normalized. Lists left empty are restarted from random vectors.
+def _spherical_kmeans(
+        vectors: np.ndarray,
+        num_lists: int,
+        num_iterations: int,
+        rng: np.random.Generator
+) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)]
+    for _ in range(num_iterations):
+        assignments = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=num_lists) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = _normalize(sums)
+    return centroids
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import contextlib
+import os
+from typing import IO, Iterator
+
+
+@contextlib.contextmanager
+def atomic_write(filepath: str, mode: str = "wb", **kwargs) -> Iterator[IO]:
+    """
+    Opens a temporary file next to filepath for writing, and renames it to
+    filepath once the block completes, so that an interrupted write never
+    leaves a partial file at filepath. If the block raises, the temporary
+    file is removed and filepath is left untouched.
+    :param filepath: Path of the file to write.
+    :param mode: The mode the temporary file is opened with, "wb" or "w".
+    :param kwargs: Passed on to open, such as encoding.
+    :return:
+    """
+    temp_filepath = f"{filepath}.tmp"
+    try:
+        with open(temp_filepath, mode, **kwargs) as file:
+            yield file
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_filepath)
+        raise
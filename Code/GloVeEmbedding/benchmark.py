@@ -0,0 +1,263 @@
+"""
+Benchmarks each stage of the GloVe pipeline on synthetic corpora, appending
+one JSON record per stage and corpus size to a results file (see
+metrics.MetricsRecorder), so that runs on different commits can be
+compared. The peak memory of each record is that of the whole run so far,
+so it only grows from one stage to the next.
+
+Usage:
+    python benchmark.py --num-tokens 100000 1000000 --vocab-size 10000
+"""
+import argparse
+import os
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.optim
+
+from cooccurrenceentries import CoOccurrenceEntries
+from fusedadagrad import FusedAdagrad
+from glove import GloVe
+from hdf5dataloader import HDF5DataLoader
+from metrics import MetricsRecorder
+from vectorizer import Vectorizer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num-tokens",
+        help="sizes of the synthetic corpora to benchmark, in tokens",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--num-types",
+        help="number of distinct words the corpora are drawn from",
+        type=int,
+        default=50_000
+    )
+    parser.add_argument(
+        "--zipf-exponent",
+        help="exponent of the Zipf distribution the words are drawn from",
+        type=float,
+        default=1.0
+    )
+    parser.add_argument(
+        "--vocab-size",
+        help="number of most frequent words kept in the vocabulary",
+        type=int,
+        default=10_000
+    )
+    parser.add_argument("--window-size", type=int, default=10)
+    parser.add_argument("--num-partitions", type=int, default=10)
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument(
+        "--build-mode",
+        choices=["loop", "vectorized", "spill"],
+        default="vectorized"
+    )
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--symmetric", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=2048)
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument(
+        "--train-steps",
+        help="number of training steps to time",
+        type=int,
+        default=200
+    )
+    parser.add_argument("--embedding-size", type=int, default=100)
+    parser.add_argument(
+        "--fused-step",
+        help="time FusedAdagrad steps instead of autograd and Adagrad",
+        action="store_true"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--results-filepath",
+        help="file to append the results to, as JSON lines",
+        default="benchmark_results.jsonl"
+    )
+    return parser.parse_args()
+
+
+def make_zipf_corpus(
+        num_tokens: int,
+        num_types: int,
+        exponent: float,
+        seed: int
+) -> list[str]:
+    """
+    Generates a corpus of num_tokens words drawn from num_types distinct
+    words, the word of frequency rank r having probability proportional to
+    1 / r ^ exponent, as is roughly the case for natural language.
+    :return: The corpus as a list of tokens of the form "w<rank>".
+    """
+    ranks = np.arange(1, num_types + 1, dtype=np.float64)
+    probabilities = ranks ** -exponent
+    probabilities /= probabilities.sum()
+    rng = np.random.default_rng(seed)
+    types = np.array([f"w{rank}" for rank in range(num_types)], dtype=object)
+    return types[rng.choice(num_types, num_tokens, p=probabilities)].tolist()
+
+
+def benchmark(args, num_tokens: int, metrics: MetricsRecorder) -> None:
+    # Fields that identify the run, stored with every record.
+    run = {
+        **vars(args),
+        **get_environment(),
+        "num_tokens": num_tokens
+    }
+    del run["results_filepath"]
+    corpus = make_zipf_corpus(
+        num_tokens,
+        args.num_types,
+        args.zipf_exponent,
+        args.seed
+    )
+
+    metrics.reset()
+    with metrics.phase("from_corpus"):
+        vectorizer = Vectorizer.from_corpus(
+            corpus,
+            vocab_size=args.vocab_size,
+            seed=args.seed
+        )
+    with metrics.phase("vectorize"):
+        cooccurrence = CoOccurrenceEntries.setup(corpus, vectorizer)
+    metrics.count("tokens", num_tokens)
+    metrics.emit("benchmark", stage="vectorizer", **run)
+
+    with tempfile.TemporaryDirectory() as directory:
+        metrics.reset()
+        with metrics.phase("build"):
+            num_entries = cooccurrence.build(
+                window_size=args.window_size,
+                num_partitions=args.num_partitions,
+                chunk_size=args.chunk_size,
+                output_directory=directory,
+                mode=args.build_mode,
+                num_workers=args.num_workers,
+                symmetric=args.symmetric
+            )
+        metrics.count("tokens", num_tokens)
+        metrics.count("cooccurrence_entries", num_entries)
+        metrics.emit("benchmark", stage="cooccurrence_build", **run)
+
+        filepath = os.path.join(directory, "_coocurrence_dataset.hdf5")
+        x_max = 100
+        alpha = 0.75
+        dataloader = HDF5DataLoader(
+            filepath=filepath,
+            dataset_name="cooccurrence",
+            batch_size=args.batch_size,
+            device=args.device,
+            prefetch=args.prefetch,
+            x_max=x_max if args.fused_step else None,
+            alpha=alpha if args.fused_step else None,
+            metrics=metrics
+        )
+        with dataloader.open():
+            metrics.reset()
+            for batch in dataloader.iter_batches():
+                metrics.count("batches")
+                metrics.count("cooccurrence_entries", len(batch[1]))
+            metrics.emit("benchmark", stage="iter_batches", **run)
+
+            torch.manual_seed(args.seed)
+            model = GloVe(
+                vocab_size=len(vectorizer.vocab),
+                embedding_size=args.embedding_size,
+                x_max=x_max,
+                alpha=alpha
+            ).to(args.device)
+            if args.fused_step:
+                optimizer = FusedAdagrad(model, lr=0.05)
+            else:
+                optimizer = torch.optim.Adagrad(model.parameters(), lr=0.05)
+            metrics.reset()
+            _train_steps(model, optimizer, dataloader, args.train_steps,
+                         metrics)
+            metrics.emit("benchmark", stage="train_steps", **run)
+
+
+# Takes num_steps training steps, going over the data as many times as
+# needed.
+def _train_steps(model, optimizer, dataloader, num_steps, metrics):
+    step = 0
+    while step < num_steps:
+        for batch in dataloader.iter_batches():
+            if step == num_steps:
+                break
+            step += 1
+            metrics.count("steps")
+            metrics.count("cooccurrence_entries", len(batch[1]))
+            if isinstance(optimizer, FusedAdagrad):
+                with metrics.phase("fused_step"):
+                    optimizer.step(
+                        batch[0][:, 0],
+                        batch[0][:, 1],
+                        batch[2],
+                        batch[3]
+                    )
+                continue
+            with metrics.phase("forward"):
+                loss = model(batch[0][:, 0], batch[0][:, 1], batch[1])
+            with metrics.phase("backward"):
+                loss.backward()
+            with metrics.phase("optimizer_step"):
+                optimizer.step()
+                optimizer.zero_grad()
+
+
+# Returns the commit and versions the benchmark is run with, so that
+# results from different runs can be told apart.
+def get_environment() -> dict:
+    directory = Path(__file__).absolute().parents[0]
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--", "."],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+        dirty = None
+    return dict(
+        commit=commit,
+        dirty=dirty,
+        python=platform.python_version(),
+        numpy=np.__version__,
+        torch=torch.__version__,
+        machine=platform.machine(),
+        cpu_count=os.cpu_count()
+    )
+
+
+def main():
+    args = parse_args()
+    metrics = MetricsRecorder(args.results_filepath)
+    for num_tokens in args.num_tokens:
+        print(f"Benchmarking a corpus of {num_tokens} tokens")
+        benchmark(args, num_tokens, metrics)
+    print(f"Results appended to {args.results_filepath}")
+
+
+if __name__ == "__main__":
+    main()
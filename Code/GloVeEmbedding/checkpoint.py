@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import torch
+
+from atomicwrite import atomic_write
+
+
+def save_checkpoint(filepath: str, model, optimizer, epoch: int, losses):
+    """
+    Saves everything needed to resume training after epoch: the model and
+    optimizer states, the losses so far and the state of the random number
+    generators. The checkpoint is written with atomic_write.
+    :param filepath: Path of the checkpoint file.
+    :param model: The GloVe model being trained.
+    :param optimizer: Its optimizer, torch.optim.Adagrad or FusedAdagrad.
+    :param epoch: The epoch that was just completed.
+    :param losses: The loss of every epoch so far.
+    :return:
+    """
+    checkpoint = {
+        "epoch": epoch,
+        "losses": list(losses),
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "rng": {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state()
+        }
+    }
+    with atomic_write(filepath) as file:
+        torch.save(checkpoint, file)
+
+
+def load_checkpoint(filepath: str, model, optimizer) -> tuple[int, list]:
+    """
+    Restores a checkpoint written by save_checkpoint into model and
+    optimizer, and restores the random number generators.
+    :param filepath: Path of the checkpoint file.
+    :param model: See save_checkpoint.
+    :param optimizer: See save_checkpoint.
+    :return: The epoch to resume training from, and the losses so far.
+    """
+    checkpoint = torch.load(filepath, weights_only=False)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    random.setstate(checkpoint["rng"]["python"])
+    np.random.set_state(checkpoint["rng"]["numpy"])
+    torch.set_rng_state(checkpoint["rng"]["torch"])
+    return checkpoint["epoch"] + 1, checkpoint["losses"]
+
+
+def should_stop_early(
+        losses,
+        min_relative_improvement: float,
+        patience: int
+) -> bool:
+    """
+    Returns True if none of the last patience epochs lowered the best loss
+    so far by at least min_relative_improvement of it.
+    :param losses: The loss of every epoch so far.
+    :param min_relative_improvement: e.g. 0.001 for 0.1%.
+    :param patience: Number of epochs without enough improvement to allow.
+    :return:
+    """
+    if len(losses) <= patience:
+        return False
+    best = min(losses[:-patience])
+    return min(losses[-patience:]) > best * (1 - min_relative_improvement)
@@ -2,14 +2,25 @@ from __future__ import annotations
 
 import os
 import pickle
+import tempfile
 from collections import Counter
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import partial
+from multiprocessing import shared_memory
 
 import h5py as h5py
 import numpy as np
 from tqdm import tqdm
 
-from vectorizer import Vectorizer
+from vectorizer import Vectorizer, _map_bounded
+
+
+# Latest layout of the co-occurrence HDF5 file, see _CoOccurrenceWriter.
+COOCCURRENCE_FORMAT_VERSION = 2
+# Names and types of the columns of a version 2 co-occurrence group.
+COOCCURRENCE_COLUMNS = (("row", "<i4"), ("col", "<i4"), ("value", "<f4"))
 
 
 @dataclass
@@ -19,13 +30,15 @@ class CoOccurrenceEntries:
     co-occurrence matrix. Also includes a build method for constructing the
     matrix.
     The body of text consists of a list of vectorized tokens, the vectors
-    constructed from the vocabulary in the vectorizer.
+    constructed from the vocabulary in the vectorizer. It can also be an
+    integer array, such as the memory map returned by
+    Vectorizer.vectorize_file.
     """
-    vectorized_corpus: list[int]
+    vectorized_corpus: list[int] | np.ndarray
     vectorizer: Vectorizer
 
     # Takes a list of tokens (the corpus) and a vectorizer, and uses the
-    # vectorizer to construct a list of indices corresponding to the tokens.
+    # vectorizer to construct an array of indices corresponding to the tokens.
     # Returns a CoOccurrenceEntry instance constructed from the vectorizer
     # and vectorized corpus.
     # Note that the vectorizer needs to have an already initialized
@@ -62,8 +75,14 @@ class CoOccurrenceEntries:
             num_partitions: int,
             chunk_size: int,
             output_directory: str = ".",
-            file_name: str | None = ""
-    ):
+            file_name: str | None = "",
+            mode: str = "loop",
+            num_workers: int = 1,
+            block_size: int = 1_000_000,
+            format_version: int = 1,
+            compression: str | None = None,
+            symmetric: bool = False
+    ) -> int:
         """
         Constructs a file containing co-occurrence matrix in HDF5 binary format.
         :param window_size: The size of the window in the corpus to evaluate
@@ -74,111 +93,600 @@ class CoOccurrenceEntries:
         :param chunk_size: Size of chunks in the HDF5 dataset.
         :param output_directory: path to directory in which to store HDF5 File.
         :param file_name: name for HDF5 file, less suffix.
+        :param mode: "loop" walks the corpus token by token in Python,
+        "vectorized" converts the corpus to a NumPy array once and counts
+        every window offset in bulk, rescanning the corpus for each partition.
+        "spill" reads the corpus once, block by block, and routes the counts
+        to one on-disk spill file per partition, which are then reduced one
+        at a time. All three produce the same HDF5 layout.
+        :param num_workers: Number of processes counting partitions (or, in
+        spill mode, reducing spill files) at the same time. Not supported by
+        the loop mode. Use at least as many partitions as workers to keep
+        them all busy.
+        :param block_size: Number of corpus tokens counted at once in spill
+        mode.
+        :param format_version: Layout of the HDF5 file, see
+        _CoOccurrenceWriter. Version 1 is a single (n, 3) float dataset,
+        version 2 stores int32 token ids and float32 values as columns.
+        :param compression: Optional chunk compression filter, "gzip" or
+        "lzf".
+        :param symmetric: The co-occurrence matrix is symmetric, so if True
+        each unordered pair is only stored once, as (i, j) with i <= j, and
+        the dataset is tagged so that HDF5DataLoader mirrors it back. Not
+        supported by the loop mode.
+        :return: The number of co-occurrence entries stored.
         """
+        if mode not in ("loop", "vectorized", "spill"):
+            raise ValueError(f"Unknown co-occurrence build mode {mode}.")
+        if format_version not in (1, COOCCURRENCE_FORMAT_VERSION):
+            raise ValueError(
+                f"Unknown co-occurrence format version {format_version}."
+            )
+        if compression not in (None, "gzip", "lzf"):
+            raise ValueError(f"Unknown compression filter {compression}.")
+        if num_workers > 1 and mode == "loop":
+            raise ValueError(
+                "Multiple workers are not supported in loop mode."
+            )
+        if symmetric and mode == "loop":
+            raise ValueError(
+                "Symmetric storage is not supported in loop mode."
+            )
+
+        split_points = self._get_split_points(num_partitions)
+        # Get indices of top and bottom of each section of vocab to be
+        # processed.
+        partitions = [
+            (split_points[partition_id], split_points[partition_id + 1] - 1)
+            for partition_id in range(len(split_points) - 1)
+        ]
+
+        if mode == "loop":
+            partition_counts = (
+                self._count_partition_loop(window_size, lower, upper)
+                for lower, upper in partitions
+            )
+        elif mode == "spill":
+            partition_counts = self._count_partitions_spilled(
+                window_size,
+                split_points,
+                num_workers,
+                block_size,
+                output_directory,
+                symmetric
+            )
+        elif num_workers > 1:
+            partition_counts = self._count_partitions_parallel(
+                window_size,
+                partitions,
+                num_workers,
+                symmetric
+            )
+        else:
+            # The vectorized mode works on a single integer array built once
+            # from the corpus, rather than on the Python list.
+            corpus_array = np.asarray(self.vectorized_corpus, dtype=np.int64)
+            partition_counts = (
+                _count_partition_vectorized(
+                    corpus_array,
+                    window_size,
+                    self.vectorizer.vocab.unk_token,
+                    len(self.vectorizer.vocab),
+                    lower,
+                    upper,
+                    symmetric
+                )
+                for lower, upper in partitions
+            )
 
-        # Get list of indices used to mark beginning and end of sections of
-        # vocabulary that will be processed in each iteration.
+        with h5py.File(
+                os.path.join(
+                    output_directory,
+                    f"{file_name}_coocurrence_dataset.hdf5"
+                ),
+                "w"
+        ) as file:
+            writer = _CoOccurrenceWriter(
+                file,
+                "cooccurrence",
+                chunk_size,
+                format_version,
+                compression,
+                symmetric
+            )
+            # Iterate through the counts of each of the sections defined in
+            # split_points, in order, appending each to the dataset.
+            for co_occurr_dataset in tqdm(
+                    partition_counts,
+                    total=len(partitions)
+            ):
+                writer.append(co_occurr_dataset)
+            num_entries = writer.columns[0].len()
+
+        # Store vocabulary as a pickled file.
+        with open(
+                os.path.join(output_directory, f"{file_name}_vocab.pickle"),
+                "wb"
+        ) as file:
+            pickle.dump(self.vectorizer.vocab, file)
+
+        return num_entries
+
+    # Get list of indices used to mark beginning and end of sections of
+    # vocabulary that will be processed in each iteration of build.
+    def _get_split_points(self, num_partitions: int) -> list[int]:
         partition_step = len(self.vectorizer.vocab) // num_partitions
         split_points = [0]
         while split_points[-1] + partition_step <= len(self.vectorizer.vocab):
             split_points.append(split_points[-1] + partition_step)
         split_points[-1] = len(self.vectorizer.vocab)
+        return split_points
 
-        file = None  # Initialized in first pass through first partition
-        dataset = None  # Initialized in first pass through first partition
-
-        # Iterate through each of the sections defined in split_points
-        for partition_id in tqdm(range(len(split_points) - 1)):
-            # Get indices of top and bottom of section of vocab to be processed.
-            index_lower = split_points[partition_id]
-            index_upper = split_points[partition_id + 1] - 1
-
-            # Initialize Counter to store co-occurrence counts.
-            # Keys will be 2-tuples of vectorized_corpus values.
-            # Values will be floats that we will increase the value of as we
-            # encounter co-occurrences. Value increase will be inversely
-            # proportional to distance between co-occurrences.
-            co_occurr_counts = Counter()
-
-            # Iterate through tokens in vectorized_corpus and embed them if
-            # the token occurs in the partition of the vocabulary currently
-            # being evaluated.
-            for i in tqdm(range(len(self.vectorized_corpus))):
-                # We use the validation mechanism to see if the word in
-                # the corpus we're looking at is in the partition of the
-                # vocabulary we're currently working on.
-                if not self.validate_index(
-                        self.vectorized_corpus[i],
-                        index_lower,
-                        index_upper
+    def _count_partitions_parallel(
+            self,
+            window_size: int,
+            partitions: list[tuple[int, int]],
+            num_workers: int,
+            symmetric: bool
+    ) -> Iterator[np.ndarray]:
+        """
+        Counts co-occurrences for each partition in a separate process,
+        yielding the results in partition order. The vectorized corpus is
+        copied once into shared memory, and every worker reads from a view
+        of it rather than receiving its own copy. At most num_workers
+        partitions are submitted at a time, so that the results waiting to
+        be written don't accumulate in memory.
+        :param window_size: See build.
+        :param partitions: (index_lower, index_upper) pairs, one per
+        partition of the vocabulary.
+        :param num_workers: Number of worker processes.
+        :param symmetric: See build.
+        :return:
+        """
+        corpus_array = np.asarray(self.vectorized_corpus, dtype=np.int64)
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=max(corpus_array.nbytes, 1)
+        )
+        try:
+            np.ndarray(
+                corpus_array.shape,
+                dtype=corpus_array.dtype,
+                buffer=shm.buf
+            )[:] = corpus_array
+            del corpus_array
+            with ProcessPoolExecutor(
+                    max_workers=num_workers,
+                    initializer=_attach_shared_corpus,
+                    initargs=(shm.name, len(self.vectorized_corpus))
+            ) as executor:
+                yield from _map_bounded(
+                    executor,
+                    partial(
+                        _count_shared_partition,
+                        window_size=window_size,
+                        unk_token=self.vectorizer.vocab.unk_token,
+                        vocab_size=len(self.vectorizer.vocab),
+                        symmetric=symmetric
+                    ),
+                    partitions,
+                    num_workers
+                )
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _count_partitions_spilled(
+            self,
+            window_size: int,
+            split_points: list[int],
+            num_workers: int,
+            block_size: int,
+            spill_directory: str,
+            symmetric: bool
+    ) -> Iterator[np.ndarray]:
+        """
+        Counts co-occurrences for every partition with a single pass over
+        the corpus, yielding the results in partition order. Each block of
+        the corpus is counted and reduced in memory, then its (i, j) entries
+        are appended to the spill file of the partition that i belongs to.
+        Once the corpus has been read, each spill file is reduced on its own,
+        at most num_workers at a time, so peak memory is bounded by the
+        largest partitions rather than by the corpus.
+        :param window_size: See build.
+        :param split_points: See _get_split_points.
+        :param num_workers: Number of processes reducing spill files.
+        :param block_size: Number of corpus tokens counted at once.
+        :param spill_directory: Directory in which to create a temporary
+        directory holding the spill files.
+        :param symmetric: See build.
+        :return:
+        """
+        corpus_length = len(self.vectorized_corpus)
+        unk_token = self.vectorizer.vocab.unk_token
+        vocab_size = len(self.vectorizer.vocab)
+
+        with tempfile.TemporaryDirectory(dir=spill_directory) as directory:
+            spill_paths = [
+                os.path.join(directory, f"partition_{partition_id}.spill")
+                for partition_id in range(len(split_points) - 1)
+            ]
+            spill_files = [open(path, "wb") for path in spill_paths]
+            try:
+                for start in tqdm(range(0, corpus_length, block_size)):
+                    end = min(start + block_size, corpus_length)
+                    # Include window_size tokens of context on either side of
+                    # the block, but only count centers inside the block, so
+                    # that every pair is counted exactly once.
+                    context_lower = max(start - window_size, 0)
+                    context_upper = min(end + window_size, corpus_length)
+                    segment = np.asarray(
+                        self.vectorized_corpus[context_lower:context_upper],
+                        dtype=np.int64
+                    )
+                    is_center = np.zeros(len(segment), dtype=bool)
+                    is_center[start - context_lower:end - context_lower] = True
+                    keys, values = _count_window_pairs(
+                        segment,
+                        window_size,
+                        unk_token,
+                        vocab_size,
+                        is_center,
+                        symmetric
+                    )
+
+                    # keys are sorted, so the entries of each partition are
+                    # contiguous.
+                    boundaries = np.searchsorted(
+                        keys,
+                        np.array(split_points, dtype=np.int64) * vocab_size
+                    )
+                    records = np.empty(len(keys), dtype=_SPILL_DTYPE)
+                    records["key"] = keys
+                    records["value"] = values
+                    for partition_id, spill_file in enumerate(spill_files):
+                        records[
+                            boundaries[partition_id]:
+                            boundaries[partition_id + 1]
+                        ].tofile(spill_file)
+            finally:
+                for spill_file in spill_files:
+                    spill_file.close()
+
+            if num_workers > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    yield from _map_bounded(
+                        executor,
+                        partial(_reduce_spill_file, vocab_size=vocab_size),
+                        spill_paths,
+                        num_workers
+                    )
+            else:
+                for path in spill_paths:
+                    yield _reduce_spill_file(path, vocab_size)
+
+    def _count_partition_loop(
+            self,
+            window_size: int,
+            index_lower: int,
+            index_upper: int
+    ) -> np.ndarray:
+        """
+        Counts co-occurrences for the tokens of one partition of the
+        vocabulary by walking through the corpus token by token.
+        :param window_size: See build.
+        :param index_lower: Lowest vocabulary index in the partition.
+        :param index_upper: Highest vocabulary index in the partition.
+        :return: A long form table of three columns: partition word i,
+        context word j, and the co-occurrence value of (i, j).
+        """
+        # Initialize Counter to store co-occurrence counts.
+        # Keys will be 2-tuples of vectorized_corpus values.
+        # Values will be floats that we will increase the value of as we
+        # encounter co-occurrences. Value increase will be inversely
+        # proportional to distance between co-occurrences.
+        co_occurr_counts = Counter()
+
+        # Iterate through tokens in vectorized_corpus and embed them if
+        # the token occurs in the partition of the vocabulary currently
+        # being evaluated.
+        for i in tqdm(range(len(self.vectorized_corpus))):
+            # We use the validation mechanism to see if the word in
+            # the corpus we're looking at is in the partition of the
+            # vocabulary we're currently working on.
+            if not self.validate_index(
+                    self.vectorized_corpus[i],
+                    index_lower,
+                    index_upper
+            ):
+                continue
+
+            # Get indices of window to assess for co-occurrence in the
+            # corpus.
+            context_lower = max(i - window_size, 0)
+            context_upper = min(i + window_size + 1,
+                                len(self.vectorized_corpus))
+
+            # Iterate through window
+            for j in range(context_lower, context_upper):
+                # Do nothing if we're in the center of the window,
+                # or if context word is not in Vocabulary. (We don't care
+                # if the context word is in the partition we're working on).
+                if i == j or not self.validate_index(
+                        self.vectorized_corpus[j],
+                        -1,
+                        -1
                 ):
                     continue
+                # Increment (or initialize) appropriate value in Counter
+                co_occurr_counts[
+                    (self.vectorized_corpus[i], self.vectorized_corpus[j])
+                ] += 1 / abs(i - j)  # Decays with distance
 
-                # Get indices of window to assess for co-occurrence in the
-                # corpus.
-                context_lower = max(i - window_size, 0)
-                context_upper = min(i + window_size + 1,
-                                    len(self.vectorized_corpus))
-
-                # Iterate through window
-                for j in range(context_lower, context_upper):
-                    # Do nothing if we're in the center of the window,
-                    # or if context word is not in Vocabulary. (We don't care
-                    # if the context word is in the partition we're working on).
-                    if i == j or not self.validate_index(
-                            self.vectorized_corpus[j],
-                            -1,
-                            -1
-                    ):
-                        continue
-                    # Increment (or initialize) appropriate value in Counter
-                    co_occurr_counts[
-                        (self.vectorized_corpus[i], self.vectorized_corpus[j])
-                    ] += 1 / abs(i - j)  # Decays with distance
-
-            # Store counter data in a numpy array as long form table
-            # consisting of three columns. The first column is partition word i,
-            # the second is context word j, and the third is the value
-            # associated with (i, j) in the co-occurrence matrix.
-            co_occurr_dataset = np.zeros((len(co_occurr_counts), 3))
-            for index, ((i, j), co_occurr_count) in enumerate(
-                    co_occurr_counts.items()):
-                co_occurr_dataset[index] = (i, j, co_occurr_count)
-
-            # If this is our first pass through, initialize file as HDF5 file
-            # that we will accumulate results in, and dataset as a dataset
-            # object stored in the file.
-            if partition_id == 0:
-                file = h5py.File(
-                    os.path.join(
-                        output_directory,
-                        f"{file_name}_coocurrence_dataset.hdf5"
-                    ),
-                    "w"
+        # Store counter data in a numpy array as long form table
+        # consisting of three columns. The first column is partition word i,
+        # the second is context word j, and the third is the value
+        # associated with (i, j) in the co-occurrence matrix.
+        co_occurr_dataset = np.zeros((len(co_occurr_counts), 3))
+        for index, ((i, j), co_occurr_count) in enumerate(
+                co_occurr_counts.items()):
+            co_occurr_dataset[index] = (i, j, co_occurr_count)
+        return co_occurr_dataset
+
+
+def _count_partition_vectorized(
+        corpus: np.ndarray,
+        window_size: int,
+        unk_token: int,
+        vocab_size: int,
+        index_lower: int,
+        index_upper: int,
+        symmetric: bool = False
+) -> np.ndarray:
+    """
+    Vectorized equivalent of CoOccurrenceEntries._count_partition_loop.
+    :param corpus: The vectorized corpus as an integer array.
+    :param window_size: See CoOccurrenceEntries.build.
+    :param unk_token: Value used to specify tokens not in the Vocabulary.
+    :param vocab_size: Number of tokens in the Vocabulary.
+    :param index_lower: Lowest vocabulary index in the partition.
+    :param index_upper: Highest vocabulary index in the partition.
+    :param symmetric: See CoOccurrenceEntries.build.
+    :return: A long form table of three columns: partition word i,
+    context word j, and the co-occurrence value of (i, j).
+    """
+    in_partition = (corpus >= index_lower) & (corpus <= index_upper)
+    if symmetric:
+        # The partition of a pair is the one of its smaller token id, so
+        # either position may hold the partition word.
+        keys, values = _count_window_pairs(
+            corpus,
+            window_size,
+            unk_token,
+            vocab_size,
+            np.ones(len(corpus), dtype=bool),
+            symmetric,
+            in_partition
+        )
+    else:
+        keys, values = _count_window_pairs(
+            corpus,
+            window_size,
+            unk_token,
+            vocab_size,
+            in_partition
+        )
+    return _to_long_form(keys, values, vocab_size)
+
+
+def _count_window_pairs(
+        corpus: np.ndarray,
+        window_size: int,
+        unk_token: int,
+        vocab_size: int,
+        is_center: np.ndarray,
+        symmetric: bool = False,
+        in_partition: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rather than visiting every window, the corpus is shifted against itself
+    once per window offset, which yields every (center, context) pair at
+    that distance in a single array operation. Pairs are encoded as
+    i * vocab_size + j so they can be reduced with np.unique.
+    :param corpus: Vectorized corpus (or a section of it) as an int64 array.
+    :param window_size: See CoOccurrenceEntries.build.
+    :param unk_token: Value used to specify tokens not in the Vocabulary.
+    :param vocab_size: Number of tokens in the Vocabulary.
+    :param is_center: Boolean mask of the positions in corpus to use as
+    center words. Unknown tokens are never used, whatever the mask says.
+    :param symmetric: If True, each pair of positions is counted once, from
+    the position on the left, and stored as (min(i, j), max(i, j)). Pairs of
+    the same token count twice, as they would once from each side.
+    :param in_partition: Optional boolean mask of the positions in corpus
+    holding a word of the partition being counted. If given, only the pairs
+    whose smaller token is one of those are kept, before they are gathered.
+    Only used in symmetric mode.
+    :return: Sorted unique pair keys, and the co-occurrence value of each.
+    """
+    in_vocab = corpus != unk_token
+    is_center = is_center & in_vocab
+
+    keys = list()
+    values = list()
+    for distance in range(1, min(window_size, len(corpus) - 1) + 1):
+        left = corpus[:-distance]
+        right = corpus[distance:]
+        if symmetric:
+            mask = is_center[:-distance] & in_vocab[distance:]
+            if in_partition is not None:
+                # Whether the smaller token of each pair is in the partition.
+                left_is_lower = right >= left
+                mask &= (
+                    (in_partition[:-distance] & left_is_lower)
+                    | (in_partition[distance:] & ~left_is_lower)
                 )
-                dataset = file.create_dataset(
-                    "cooccurrence",
-                    (len(co_occurr_counts), 3),
+            left_tokens = left[mask]
+            right_tokens = right[mask]
+            distance_keys, counts = np.unique(
+                np.minimum(left_tokens, right_tokens) * vocab_size
+                + np.maximum(left_tokens, right_tokens),
+                return_counts=True
+            )
+            # Pairs of the same token count twice.
+            same_token = distance_keys // vocab_size \
+                == distance_keys % vocab_size
+            keys.append(distance_keys)
+            values.append(counts * (1 + same_token) / distance)
+            continue
+        # Center word on the left of the context word, then on the right.
+        for center, context, mask in (
+                (left, right, is_center[:-distance] & in_vocab[distance:]),
+                (right, left, is_center[distance:] & in_vocab[:-distance])
+        ):
+            distance_keys, counts = np.unique(
+                center[mask] * vocab_size + context[mask],
+                return_counts=True
+            )
+            keys.append(distance_keys)
+            values.append(counts / distance)  # Decays with distance
+
+    return _reduce_pairs(keys, values)
+
+
+# Sums the values of duplicate keys across several arrays of keys.
+def _reduce_pairs(
+        keys: list[np.ndarray],
+        values: list[np.ndarray]
+) -> tuple[np.ndarray, np.ndarray]:
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    values = np.bincount(
+        inverse,
+        weights=np.concatenate(values),
+        minlength=len(keys)
+    )
+    return keys, values
+
+
+# Converts pair keys and values to the long form table stored in the HDF5
+# dataset: word i, word j, co-occurrence value of (i, j).
+def _to_long_form(
+        keys: np.ndarray,
+        values: np.ndarray,
+        vocab_size: int
+) -> np.ndarray:
+    co_occurr_dataset = np.empty((len(keys), 3))
+    co_occurr_dataset[:, 0] = keys // vocab_size
+    co_occurr_dataset[:, 1] = keys % vocab_size
+    co_occurr_dataset[:, 2] = values
+    return co_occurr_dataset
+
+
+class _CoOccurrenceWriter:
+    """
+    Appends long form co-occurrence tables to an HDF5 file in one of the
+    supported layouts, tagging the data with its format version.
+    Version 1 is a single dataset of shape (n, 3), with word i, word j and
+    the co-occurrence value stored as floats.
+    Version 2 is a group holding three columns of equal length and chunking:
+    "row" and "col" (int32 token ids) and "value" (float32).
+    Either is tagged as symmetric when only pairs with i <= j are stored.
+    """
+
+    def __init__(
+            self,
+            file: h5py.File,
+            name: str,
+            chunk_size: int,
+            format_version: int,
+            compression: str | None,
+            symmetric: bool = False
+    ):
+        self.format_version = format_version
+        if format_version == 1:
+            self.columns = [
+                file.create_dataset(
+                    name,
+                    (0, 3),
+                    dtype="f4",
                     maxshape=(None, 3),
-                    chunks=(chunk_size, 3)
+                    chunks=(chunk_size, 3),
+                    compression=compression
                 )
-                prev_len = 0
-            # Otherwise, increase the size of the dataset object so we can
-            # add our new co_occur_dataset object to it.
-            else:
-                prev_len = dataset.len()
-                # increase the number of rows of data, so that we can add the
-                # data from the partition we just processed.
-                dataset.resize(dataset.len() + len(co_occurr_counts), axis=0)
-            # Update the appropriate rows in the dataset with our current
-            # co_occurr_dataset.
-            dataset[prev_len: dataset.len()] = co_occurr_dataset
+            ]
+            attrs = self.columns[0].attrs
+        else:
+            group = file.create_group(name)
+            attrs = group.attrs
+            self.columns = [
+                group.create_dataset(
+                    column,
+                    (0,),
+                    dtype=dtype,
+                    maxshape=(None,),
+                    chunks=(chunk_size,),
+                    compression=compression
+                )
+                for column, dtype in COOCCURRENCE_COLUMNS
+            ]
+        attrs["format_version"] = format_version
+        attrs["symmetric"] = symmetric
 
-        file.close()
+    def append(self, co_occurr_dataset: np.ndarray) -> None:
+        # Increase the number of rows of data, so that we can add the data
+        # from the partition we just processed, then fill in those rows.
+        prev_len = self.columns[0].len()
+        new_len = prev_len + len(co_occurr_dataset)
+        if self.format_version == 1:
+            self.columns[0].resize(new_len, axis=0)
+            self.columns[0][prev_len:new_len] = co_occurr_dataset
+            return
+        for index, column in enumerate(self.columns):
+            column.resize(new_len, axis=0)
+            column[prev_len:new_len] = co_occurr_dataset[:, index]
 
-        # Store vocabulary as a pickled file.
-        with open(
-                os.path.join(output_directory, f"{file_name}_vocab.pickle"),
-                "wb"
-        ) as file:
-            pickle.dump(self.vectorizer.vocab, file)
+
+# Record layout of the spill files written in spill mode.
+_SPILL_DTYPE = np.dtype([("key", "<i8"), ("value", "<f8")])
+
+
+def _reduce_spill_file(path: str, vocab_size: int) -> np.ndarray:
+    records = np.fromfile(path, dtype=_SPILL_DTYPE)
+    keys, values = _reduce_pairs([records["key"]], [records["value"]])
+    return _to_long_form(keys, values, vocab_size)
+
+
+# View of the vectorized corpus in shared memory, set in each worker process
+# by _attach_shared_corpus.
+_shared_corpus: np.ndarray | None = None
+_shared_corpus_memory: shared_memory.SharedMemory | None = None
+
+
+def _attach_shared_corpus(name: str, length: int) -> None:
+    global _shared_corpus, _shared_corpus_memory
+    _shared_corpus_memory = shared_memory.SharedMemory(name=name)
+    _shared_corpus = np.ndarray(
+        (length,),
+        dtype=np.int64,
+        buffer=_shared_corpus_memory.buf
+    )
+
+
+def _count_shared_partition(
+        partition: tuple[int, int],
+        window_size: int,
+        unk_token: int,
+        vocab_size: int,
+        symmetric: bool
+) -> np.ndarray:
+    index_lower, index_upper = partition
+    return _count_partition_vectorized(
+        _shared_corpus,
+        window_size,
+        unk_token,
+        vocab_size,
+        index_lower,
+        index_upper,
+        symmetric
+    )
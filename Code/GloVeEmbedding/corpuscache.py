@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+
+import nltk
+import numpy as np
+from nltk.tokenize import word_tokenize
+
+from atomicwrite import atomic_write
+from vectorizer import Vectorizer
+
+# Bump whenever the layout of the cache files changes, so that old entries
+# are no longer picked up.
+CACHE_FORMAT_VERSION = 2
+
+
+def get_cache_key(
+        input_filepath: str,
+        vocab_size: int | None,
+        streaming: bool,
+        chunk_size: int,
+        seed: int | None = None
+) -> str:
+    """
+    Returns a key identifying a vectorized corpus: a hash of the contents of
+    the input file and of every setting that changes the token ids.
+    :param input_filepath: Path to the text file to tokenize.
+    :param vocab_size: See Vectorizer.from_corpus.
+    :param streaming: Whether the file is tokenized a chunk at a time.
+    :param chunk_size: Number of characters tokenized at once when
+    streaming. Chunk boundaries can change how sentences are split, so this
+    is part of the key.
+    :param seed: Seed used to shuffle the Vocabulary.
+    :return:
+    """
+    file_hash = hashlib.sha256()
+    with open(input_filepath, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(block)
+    settings = {
+        "cache_format_version": CACHE_FORMAT_VERSION,
+        "tokenizer": "nltk.tokenize.word_tokenize",
+        "nltk_version": nltk.__version__,
+        "vocab_size": vocab_size,
+        "streaming": streaming,
+        "chunk_size": chunk_size if streaming else None,
+        "seed": seed,
+        "file_hash": file_hash.hexdigest()
+    }
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True).encode()
+    ).hexdigest()[:16]
+
+
+def load_vectorized_corpus(
+        input_filepath: str,
+        cache_directory: str,
+        vocab_size: int | None = None,
+        streaming: bool = False,
+        chunk_size: int = 10_000_000,
+        num_workers: int = 1,
+        seed: int | None = None
+) -> tuple[Vectorizer, np.memmap]:
+    """
+    Returns a Vectorizer built from the input file, and the vectorized file
+    as a read-only memory map of int32 token ids. Both are cached in
+    cache_directory under a key computed by get_cache_key, so that later
+    calls with the same file and settings skip tokenization entirely, and
+    changes to either are picked up automatically.
+    :param input_filepath: Path to the text file to tokenize.
+    :param cache_directory: Directory in which to store the cache files.
+    :param vocab_size: See Vectorizer.from_corpus.
+    :param streaming: If True, tokenize the file a chunk at a time (see
+    Vectorizer.from_file), otherwise all at once.
+    :param chunk_size: Number of characters tokenized at once when
+    streaming.
+    :param num_workers: Number of processes tokenizing and counting chunks
+    when streaming, see Vectorizer.from_file. Without streaming, the file is
+    tokenized and counted in a single process.
+    :param seed: Seed used to shuffle the Vocabulary, part of the cache key.
+    :return:
+    """
+    key = get_cache_key(
+        input_filepath,
+        vocab_size,
+        streaming,
+        chunk_size,
+        seed
+    )
+    corpus_filepath = os.path.join(cache_directory, f"{key}_corpus.int32")
+    vocab_filepath = os.path.join(cache_directory, f"{key}_vocab.pickle")
+
+    # The vocabulary is written last, so its presence means that the
+    # corpus file is complete.
+    if os.path.exists(vocab_filepath):
+        with open(vocab_filepath, "rb") as file:
+            vectorizer = Vectorizer(pickle.load(file))
+        return vectorizer, np.memmap(corpus_filepath, dtype=np.int32, mode="r")
+
+    os.makedirs(cache_directory, exist_ok=True)
+    if streaming:
+        vectorizer = Vectorizer.from_file(
+            filepath=input_filepath,
+            vocab_size=vocab_size,
+            chunk_size=chunk_size,
+            num_workers=num_workers,
+            seed=seed
+        )
+        vectorizer.vectorize_file(
+            filepath=input_filepath,
+            output_filepath=corpus_filepath,
+            chunk_size=chunk_size
+        )
+    else:
+        with open(input_filepath, "r") as file:
+            corpus = word_tokenize(file.read())
+        vectorizer = Vectorizer.from_corpus(
+            corpus=corpus,
+            vocab_size=vocab_size,
+            seed=seed
+        )
+        with atomic_write(corpus_filepath) as file:
+            vectorizer.vectorize(corpus).tofile(file)
+        del corpus
+
+    with atomic_write(vocab_filepath) as file:
+        pickle.dump(vectorizer.vocab, file)
+
+    return vectorizer, np.memmap(corpus_filepath, dtype=np.int32, mode="r")
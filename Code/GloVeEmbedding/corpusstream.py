@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Iterator
+
+from nltk.tokenize import word_tokenize
+
+
+def iter_text_chunks(filepath: str, chunk_size: int) -> Iterator[str]:
+    """
+    Reads a text file a bounded piece at a time.
+    :param filepath: Path to the text file.
+    :param chunk_size: Approximate number of characters read at once. Each
+    chunk is extended to the end of the line it stops in, so that no word is
+    split between two chunks.
+    :return: An iterator over the text of each chunk, in order.
+    """
+    with open(filepath, "r") as file:
+        while True:
+            text = file.read(chunk_size)
+            if not text:
+                break
+            yield text + file.readline()
+
+
+def iter_token_chunks(
+        filepath: str,
+        chunk_size: int,
+        tokenize: Callable[[str], list[str]] = word_tokenize
+) -> Iterator[list[str]]:
+    """
+    Tokenizes a text file a bounded piece at a time, so that the whole file
+    never has to be held in memory as a string or as a list of tokens.
+    :param filepath: Path to the text file.
+    :param chunk_size: See iter_text_chunks.
+    :param tokenize: Function splitting a string into a list of tokens.
+    :return: An iterator over the lists of tokens of each chunk, in order.
+    """
+    for text in iter_text_chunks(filepath, chunk_size):
+        yield tokenize(text)
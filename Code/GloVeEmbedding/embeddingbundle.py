@@ -0,0 +1,108 @@
+"""
+Reads and writes trained word vectors as a self-describing directory that
+can be loaded without torch or the GloVe model:
+    vectors.npy    the (V, d) float32 vectors, memory mapped when loaded
+    tokens.json    the token of each row, as a JSON list
+    metadata.json  the format version, shape and training parameters
+"""
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from atomicwrite import atomic_write
+
+# Increment when the files of a bundle change.
+EMBEDDING_BUNDLE_FORMAT_VERSION = 1
+VECTORS_FILENAME = "vectors.npy"
+TOKENS_FILENAME = "tokens.json"
+METADATA_FILENAME = "metadata.json"
+
+
+@dataclass
+class EmbeddingBundle:
+    """
+    :param vectors: The (V, d) float32 vectors, a read-only memory map when
+    loaded with mmap, so that processes loading the same bundle share its
+    pages.
+    :param tokens: The token of each row of vectors.
+    :param metadata: See export_embeddings.
+    """
+    vectors: np.ndarray
+    tokens: list[str]
+    metadata: dict
+
+
+def export_embeddings(
+        directory: str,
+        vectors: np.ndarray,
+        tokens: list[str],
+        **metadata
+) -> None:
+    """
+    Writes vectors and tokens as an embedding bundle in directory, which is
+    created if needed. Each file is written with atomic_write, and
+    metadata.json is written last, so a bundle is only loadable once it is
+    complete.
+    :param directory: The directory of the bundle.
+    :param vectors: A (V, d) array, stored as float32.
+    :param tokens: The V tokens the rows of vectors are the embeddings of.
+    :param metadata: Extra JSON serializable values to store, such as the
+    parameters the vectors were trained with.
+    :return:
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or len(vectors) != len(tokens):
+        raise ValueError(
+            f"Expected one row of vectors per token, got vectors of shape "
+            f"{vectors.shape} for {len(tokens)} tokens."
+        )
+    os.makedirs(directory, exist_ok=True)
+    metadata_filepath = os.path.join(directory, METADATA_FILENAME)
+    # Make any previous bundle unloadable while it is being replaced.
+    if os.path.exists(metadata_filepath):
+        os.remove(metadata_filepath)
+
+    with atomic_write(os.path.join(directory, VECTORS_FILENAME)) as file:
+        np.save(file, vectors)
+    _write_json(os.path.join(directory, TOKENS_FILENAME), list(tokens))
+    _write_json(metadata_filepath, {
+        "format_version": EMBEDDING_BUNDLE_FORMAT_VERSION,
+        "vocab_size": vectors.shape[0],
+        "embedding_size": vectors.shape[1],
+        "dtype": str(vectors.dtype),
+        **metadata
+    })
+
+
+def load_embeddings(directory: str, mmap: bool = True) -> EmbeddingBundle:
+    """
+    Loads an embedding bundle written by export_embeddings.
+    :param directory: The directory of the bundle.
+    :param mmap: If True, the vectors are memory mapped read-only rather
+    than read into memory.
+    :return:
+    """
+    with open(os.path.join(directory, METADATA_FILENAME)) as file:
+        metadata = json.load(file)
+    if metadata["format_version"] != EMBEDDING_BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported embedding bundle format version "
+            f"{metadata['format_version']}."
+        )
+    vectors = np.load(
+        os.path.join(directory, VECTORS_FILENAME),
+        mmap_mode="r" if mmap else None
+    )
+    with open(os.path.join(directory, TOKENS_FILENAME),
+              encoding="utf-8") as file:
+        tokens = json.load(file)
+    return EmbeddingBundle(vectors=vectors, tokens=tokens, metadata=metadata)
+
+
+def _write_json(filepath: str, value) -> None:
+    with atomic_write(filepath, "w", encoding="utf-8") as file:
+        json.dump(value, file, ensure_ascii=False)
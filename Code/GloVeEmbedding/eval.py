@@ -3,10 +3,12 @@ import os
 import argparse
 import pickle
 
-import torch
+import numpy as np
 import yaml
-from gensim.models.keyedvectors import KeyedVectors
-from glove import GloVe
+
+from annindex import ANNIndex
+from embeddingbundle import METADATA_FILENAME, load_embeddings
+from similarityqueries import SimilarityQueries
 
 
 def load_config():
@@ -21,6 +23,40 @@ def load_config():
 
 def main():
     config = load_config()
+    if config.export_directory is not None and os.path.exists(
+            os.path.join(config.export_directory, METADATA_FILENAME)
+    ):
+        bundle = load_embeddings(config.export_directory)
+        queries = SimilarityQueries(bundle.vectors, bundle.tokens)
+    else:
+        queries = SimilarityQueries(*_load_model_vectors(config))
+
+    index = None
+    if config.ann_index_filepath is not None:
+        index = _get_ann_index(config, queries)
+
+    # Each batch of queries is answered with a single matrix multiply.
+    pairs = [("woman", "man"), ("apple", "man"), ("apple", "woman")]
+    for (first, second), similarity in zip(pairs, queries.similarity(pairs)):
+        print(f"How similar is {second} and {first}:")
+        print(similarity)
+    words = ["computer", "united", "early"]
+    if index is not None:
+        most_similar = [index.most_similar(word) for word in words]
+    else:
+        most_similar = queries.most_similar(words)
+    for word, neighbours in zip(words, most_similar):
+        print(f"Most similar words of {word}:")
+        print([neighbour for neighbour, _ in neighbours])
+
+
+# Returns the word vectors of the trained model and their tokens, for when
+# they weren't exported at the end of training.
+def _load_model_vectors(config):
+    # Only imported here, as loading exported embeddings doesn't need torch.
+    import torch
+    from glove import GloVe
+
     with open(os.path.join(config.cooccurrence_dir, "vocab.pkl"), "rb") as f:
         vocab = pickle.load(f)
 
@@ -31,25 +67,40 @@ def main():
         alpha=config.alpha
     )
     model.load_state_dict(torch.load(config.output_filepath))
+    vectors = (model.weight.weight.detach()
+               + model.weight_tilde.weight.detach()).numpy()
+    tokens = [vocab.get_token(index) for index in range(config.vocab_size)]
+    return vectors, tokens
 
-    keyed_vectors = KeyedVectors(vector_size=config.embedding_size)
-    keyed_vectors.add_vectors(
-        keys=[vocab.get_token(index) for index in range(config.vocab_size)],
-        weights=(model.weight.weight.detach()
-                 + model.weight_tilde.weight.detach()).numpy()
-    )
 
-    print("How similar is man and woman:")
-    print(keyed_vectors.similarity("woman", "man"))
-    print("How similar is man and apple:")
-    print(keyed_vectors.similarity("apple", "man"))
-    print("How similar is woman and apple:")
-    print(keyed_vectors.similarity("apple", "woman"))
-    for word in ["computer", "united", "early"]:
-        print(f"Most similar words of {word}:")
-        most_similar_words = [word for word, _ in
-                              keyed_vectors.similar_by_word(word)]
-        print(most_similar_words)
+# Loads the nearest neighbour index at config.ann_index_filepath, or builds
+# it from the word vectors and saves it there if it doesn't exist yet or was
+# built from other vectors, e.g. those of a previous training run.
+def _get_ann_index(config, queries):
+    index = None
+    if os.path.exists(config.ann_index_filepath):
+        index = ANNIndex.load(config.ann_index_filepath)
+        if not index.was_built_from(queries.vectors, queries.tokens):
+            print("The nearest neighbour index is out of date, rebuilding it")
+            index = None
+    if index is None:
+        index = ANNIndex.build(
+            queries.vectors,
+            tokens=queries.tokens,
+            num_lists=config.ann_num_lists,
+            nprobe=config.ann_nprobe,
+            seed=config.seed
+        )
+        index.save(config.ann_index_filepath)
+    rng = np.random.default_rng(config.seed)
+    sample = queries.vectors[rng.choice(
+        len(queries.vectors),
+        min(1000, len(queries.vectors)),
+        replace=False
+    )]
+    print(f"Recall@10 of the nearest neighbour index: "
+          f"{index.recall(sample, k=10):.3f}")
+    return index
 
 
 if __name__ == "__main__":
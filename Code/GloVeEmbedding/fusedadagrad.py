@@ -0,0 +1,101 @@
+import torch
+
+from glove import GloVe
+
+
+class FusedAdagrad:
+    """
+    Trains a GloVe model without autograd. Each step computes the gradients
+    of the GloVe objective in closed form and applies the AdaGrad update in
+    place to the rows touched by the batch. Equivalent to calling the model
+    and stepping torch.optim.Adagrad (with default lr_decay, weight_decay
+    and initial_accumulator_value) on the same batch, but with far fewer
+    intermediate tensors.
+    The batch is expected to come with log(x) and the weighting f(x)
+    already computed, see HDF5DataLoader.
+    """
+
+    def __init__(self, model: GloVe, lr: float, eps: float = 1e-10):
+        self.model = model
+        self.lr = lr
+        self.eps = eps
+        # Sum of squared gradients of each parameter, as in Adagrad.
+        self.state_sums = {
+            name: torch.zeros_like(param)
+            for name, param in model.named_parameters()
+        }
+
+    @torch.no_grad()
+    def step(
+            self,
+            i: torch.Tensor,
+            j: torch.Tensor,
+            log_x: torch.Tensor,
+            weight: torch.Tensor
+    ) -> float:
+        """
+        Updates the model with one batch.
+        :param i: Target token ids.
+        :param j: Context token ids.
+        :param log_x: Log of the co-occurrence values of (i, j).
+        :param weight: GloVe weighting of the co-occurrence values of (i, j).
+        :return: The loss of the batch, before the update.
+        """
+        w_i = self.model.weight.weight[i]
+        w_tilde_j = self.model.weight_tilde.weight[j]
+        diff = (w_i * w_tilde_j).sum(dim=1)
+        diff += self.model.bias[i]
+        diff += self.model.bias_tilde[j]
+        diff -= log_x
+        loss = (weight * diff.square()).mean().item()
+
+        # Derivative of the loss with respect to diff.
+        grad_diff = weight * diff
+        grad_diff *= 2 / len(diff)
+
+        self._update("weight.weight", i, grad_diff[:, None] * w_tilde_j)
+        self._update("weight_tilde.weight", j, grad_diff[:, None] * w_i)
+        self._update("bias", i, grad_diff)
+        self._update("bias_tilde", j, grad_diff)
+        return loss
+
+    # Moves parameters and AdaGrad state into shared memory, so that the
+    # optimizer can be used by several processes at once.
+    def share_memory(self) -> None:
+        for state_sum in self.state_sums.values():
+            state_sum.share_memory_()
+
+    def state_dict(self) -> dict:
+        return {
+            "lr": self.lr,
+            "eps": self.eps,
+            "state_sums": self.state_sums
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.lr = state_dict["lr"]
+        self.eps = state_dict["eps"]
+        for name, state_sum in state_dict["state_sums"].items():
+            self.state_sums[name].copy_(state_sum)
+
+    # Applies AdaGrad to the rows of a parameter. grad holds one gradient
+    # per item of the batch, and index the row each applies to. Gradients
+    # of repeated rows are summed first, as for a sparse gradient.
+    def _update(
+            self,
+            name: str,
+            index: torch.Tensor,
+            grad: torch.Tensor
+    ) -> None:
+        param = self.model.get_parameter(name)
+        state_sum = self.state_sums[name]
+        rows, inverse = torch.unique(index, return_inverse=True)
+        row_grad = grad.new_zeros((len(rows),) + grad.shape[1:])
+        row_grad.index_add_(0, inverse, grad)
+        row_state_sum = state_sum[rows].addcmul_(row_grad, row_grad)
+        state_sum[rows] = row_state_sum
+        param[rows] = param[rows].addcdiv_(
+            row_grad,
+            row_state_sum.sqrt_().add_(self.eps),
+            value=-self.lr
+        )
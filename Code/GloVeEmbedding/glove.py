@@ -32,11 +32,22 @@ class GloVe(nn.Module):
                 dtype=torch.float,
             )
         )
-        self.weighting_func = \
-            lambda x: (x / x_max).float_power(alpha).clamp(0, 1)
+        self.x_max = x_max
+        self.alpha = alpha
 
-    def forward(self, i, j, x):
+    # A method rather than a lambda, so the model can be pickled to start
+    # hogwild workers with the spawn start method.
+    def weighting_func(self, x):
+        return (x / self.x_max).float_power(self.alpha).clamp(0, 1)
+
+    # log_x and weight can be passed in when they have already been computed
+    # from x, see HDF5DataLoader.
+    def forward(self, i, j, x, log_x=None, weight=None):
+        if log_x is None:
+            log_x = x.log()
+        if weight is None:
+            weight = self.weighting_func(x)
         loss = torch.mul(self.weight(i), self.weight_tilde(j)).sum(dim=1)
-        loss = (loss + self.bias[i] + self.bias_tilde[j] - x.log()).square()
-        loss = torch.mul(self.weighting_func(x), loss).mean()
+        loss = (loss + self.bias[i] + self.bias_tilde[j] - log_x).square()
+        loss = torch.mul(weight, loss).mean()
         return loss
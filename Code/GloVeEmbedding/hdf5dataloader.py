@@ -1,4 +1,8 @@
+from __future__ import annotations
+
 import contextlib
+import queue
+import threading
 from dataclasses import dataclass, field
 
 import h5py
@@ -6,6 +10,13 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from metrics import MetricsRecorder
+
+
+# Suffixes of the names of the datasets holding the log and the weighting of
+# the co-occurrence values, see add_weighting_columns.
+WEIGHTING_COLUMN_SUFFIXES = ("_log_x", "_weight")
+
 
 @dataclass
 class CoOccurrenceDataset(torch.utils.data.Dataset):
@@ -27,40 +38,326 @@ class CoOccurrenceDataset(torch.utils.data.Dataset):
 
 @dataclass
 class HDF5DataLoader:
+    """
+    Iterates over the co-occurrence data written by CoOccurrenceEntries.build
+    in shuffled batches, reading one HDF5 chunk at a time.
+    :param prefetch: If greater than 0, chunks are read, decoded and shuffled
+    by a background thread, up to this many ahead of the chunk being
+    iterated over, and batches are sliced directly from the shuffled chunk.
+    If 0, each chunk is read when it is needed.
+    :param shard: Index of the shard of the data to iterate over.
+    :param num_shards: Number of shards the data is split into, so that
+    several workers can each iterate over their own part of it. The rows of
+    every HDF5 chunk are split evenly between the shards, so every shard
+    gets data however few chunks there are.
+    :param x_max: If given along with alpha, each batch also includes the
+    log of the co-occurrence values and their GloVe weighting, read from the
+    file if they were stored for the same x_max and alpha (see
+    add_weighting_columns), or else computed once per chunk.
+    :param alpha: See x_max.
+    :param metrics: Records the time spent reading from the HDF5 file
+    ("hdf5_read") and converting to tensors ("to_tensor").
+    """
     filepath: str
     dataset_name: str
     batch_size: int
     device: str
-    dataset: h5py.Dataset = field(init=False)
+    prefetch: int = 0
+    shard: int = 0
+    num_shards: int = 1
+    x_max: float | None = None
+    alpha: float | None = None
+    metrics: MetricsRecorder = field(default_factory=MetricsRecorder)
+    dataset: h5py.Dataset | h5py.Group = field(init=False)
 
     def iter_batches(self):
-        chunks = list(self.dataset.iter_chunks())
+        if self.prefetch > 0:
+            yield from self._iter_batches_prefetched()
+            return
+        if self.x_max is not None:
+            yield from self._iter_weighted_batches()
+            return
+
+        chunks = self._get_chunks()
         np.random.shuffle(chunks)
         for chunk in chunks:
-            chunked_dataset = self.dataset[chunk]
+            with self.metrics.phase("hdf5_read"):
+                token_ids, co_occurr_counts = self._read_chunk(chunk)
             dataloader = torch.utils.data.DataLoader(
                 dataset=CoOccurrenceDataset(
-                    # token_ids will be the first two columns of the dataset
-                    # chunk, corresponding to target tokens and context
+                    # token_ids will be the target tokens and context
                     # tokens, respectively. Both are in vectorized format
                     # here, as integers.
-                    token_ids=torch.from_numpy(chunked_dataset[:, :2]).long(),
-                    # co_occur_counts will be the third row of the dataset
-                    # chunk, the floating point value calculated for our
-                    # target token and context token.
+                    token_ids=torch.from_numpy(token_ids).long(),
+                    # co_occur_counts will be the floating point value
+                    # calculated for our target token and context token.
                     co_occurr_counts= \
-                        torch.from_numpy(chunked_dataset[:, 2]).float()
+                        torch.from_numpy(co_occurr_counts).float()
                 ),
                 batch_size=self.batch_size,
                 shuffle=True,
-                pin_memory=True
+                # Pinned memory only speeds up copies to a GPU.
+                pin_memory=str(self.device).startswith("cuda")
             )
             for batch in dataloader:
                 batch = [_.to(self.device) for _ in batch]
                 yield batch
 
+    def _iter_batches_prefetched(self):
+        chunks = self._get_chunks()
+        np.random.shuffle(chunks)
+        loaded = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        # Puts item in the queue, unless iteration has been stopped.
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def load_chunks():
+            try:
+                for chunk in chunks:
+                    if not put(self._load_chunk(chunk)):
+                        return
+                put(None)
+            except BaseException as error:
+                put(error)
+
+        thread = threading.Thread(target=load_chunks, daemon=True)
+        thread.start()
+        try:
+            while (item := loaded.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                for start in range(0, len(item[0]), self.batch_size):
+                    yield [
+                        column[start:start + self.batch_size]
+                        for column in item
+                    ]
+        finally:
+            stop.set()
+            thread.join()
+
+    # Iterates over batches sliced from shuffled chunks, read when needed.
+    def _iter_weighted_batches(self):
+        chunks = self._get_chunks()
+        np.random.shuffle(chunks)
+        for chunk in chunks:
+            columns = self._load_chunk(chunk)
+            for start in range(0, len(columns[0]), self.batch_size):
+                yield [
+                    column[start:start + self.batch_size]
+                    for column in columns
+                ]
+
+    # Reads the rows in chunk as tensors on self.device, in a random order:
+    # token ids and co-occurrence values, followed by the log and weighting
+    # of the co-occurrence values if x_max is set. Those are read from the
+    # file if it holds columns computed for the same x_max and alpha (see
+    # add_weighting_columns), and computed here otherwise.
+    def _load_chunk(self, chunk: slice) -> list[torch.Tensor]:
+        with self.metrics.phase("hdf5_read"):
+            columns = self._read_chunk(
+                chunk,
+                with_weighting=self.has_weighting_columns
+            )
+        with self.metrics.phase("to_tensor"):
+            return self._to_tensors(columns)
+
+    # Converts the columns read from a chunk to tensors on self.device, in
+    # a random order, computing the log and weighting of the co-occurrence
+    # values if they are needed and were not read from the file.
+    def _to_tensors(self, columns: list[np.ndarray]) -> list[torch.Tensor]:
+        columns[0] = columns[0].astype(np.int64)
+        columns[1] = columns[1].astype(np.float32)
+        if self.x_max is not None and not self.has_weighting_columns:
+            columns += get_weighting_columns(
+                columns[1],
+                self.x_max,
+                self.alpha
+            )
+        permutation = torch.randperm(len(columns[1]))
+        return [
+            torch.from_numpy(column)[permutation].to(self.device)
+            for column in columns
+        ]
+
+    # Returns the version of the layout of the co-occurrence data, as
+    # written by CoOccurrenceEntries.build. Files written before the layout
+    # was versioned are version 1.
+    @property
+    def format_version(self) -> int:
+        return int(self.dataset.attrs.get("format_version", 1))
+
+    # Returns the slices of rows making up this loader's shard of each HDF5
+    # chunk of the data, leaving out empty ones.
+    def _get_chunks(self) -> list[slice]:
+        if self.format_version == 1:
+            chunks = self.dataset.iter_chunks()
+        else:
+            chunks = self.dataset["row"].iter_chunks()
+        shards = list()
+        for chunk in chunks:
+            rows = chunk[0]
+            length = rows.stop - rows.start
+            start = rows.start + length * self.shard // self.num_shards
+            stop = rows.start + length * (self.shard + 1) // self.num_shards
+            if start < stop:
+                shards.append(slice(start, stop))
+        return shards
+
+    # Returns True if only one orientation of each pair of tokens is stored.
+    @property
+    def symmetric(self) -> bool:
+        return bool(self.dataset.attrs.get("symmetric", False))
+
+    # Returns True if x_max is set and the file holds log and weighting
+    # columns computed for the same x_max and alpha.
+    @property
+    def has_weighting_columns(self) -> bool:
+        if self.x_max is None:
+            return False
+        file = self.dataset.file
+        for suffix in WEIGHTING_COLUMN_SUFFIXES:
+            name = f"{self.dataset_name}{suffix}"
+            if name not in file:
+                return False
+            if (file[name].attrs.get("x_max") != self.x_max
+                    or file[name].attrs.get("alpha") != self.alpha):
+                return False
+        return True
+
+    # Reads the rows in chunk, returning an (n, 2) array of target and
+    # context token ids and an array of their n co-occurrence values,
+    # followed by arrays of their log and weighting if with_weighting.
+    def _read_chunk(
+            self,
+            chunk: slice,
+            with_weighting: bool = False
+    ) -> list[np.ndarray]:
+        if self.format_version == 1:
+            # Version 1 stores the token ids as the first two columns of a
+            # float dataset, and the co-occurrence values as the third.
+            chunked_dataset = self.dataset[chunk]
+            token_ids = chunked_dataset[:, :2]
+            co_occurr_counts = chunked_dataset[:, 2]
+        else:
+            # Version 2 stores each as its own typed column.
+            token_ids = np.stack(
+                [self.dataset["row"][chunk], self.dataset["col"][chunk]],
+                axis=1
+            )
+            co_occurr_counts = self.dataset["value"][chunk]
+        columns = [token_ids, co_occurr_counts]
+        if with_weighting:
+            columns += [
+                self.dataset.file[f"{self.dataset_name}{suffix}"][chunk]
+                for suffix in WEIGHTING_COLUMN_SUFFIXES
+            ]
+        if self.symmetric:
+            # Symmetric data only stores (i, j) with i <= j, so add (j, i)
+            # for every pair that isn't on the diagonal.
+            mirrored = token_ids[:, 0] != token_ids[:, 1]
+            columns[0] = np.concatenate(
+                [token_ids, token_ids[mirrored, ::-1]]
+            )
+            columns[1:] = [
+                np.concatenate([column, column[mirrored]])
+                for column in columns[1:]
+            ]
+        return columns
+
     @contextlib.contextmanager
     def open(self):
         with h5py.File(self.filepath, "r") as file:
             self.dataset = file[self.dataset_name]
             yield
+
+
+def get_weighting_columns(
+        co_occurr_counts: np.ndarray,
+        x_max: float,
+        alpha: float
+) -> list[np.ndarray]:
+    """
+    Computes the parts of the GloVe objective that only depend on the
+    co-occurrence values x: log(x) and the weighting (x / x_max) ^ alpha,
+    capped at 1. See GloVe.forward.
+    :return: log(x) and the weighting, as float32 arrays.
+    """
+    co_occurr_counts = co_occurr_counts.astype(np.float64)
+    log_x = np.log(co_occurr_counts)
+    weight = np.minimum((co_occurr_counts / x_max) ** alpha, 1)
+    return [log_x.astype(np.float32), weight.astype(np.float32)]
+
+
+def add_weighting_columns(
+        filepath: str,
+        dataset_name: str,
+        x_max: float,
+        alpha: float,
+        compression: str | None = None
+) -> None:
+    """
+    Stores the log and weighting of the co-occurrence values (see
+    get_weighting_columns) in the HDF5 file, as two float32 datasets next
+    to the co-occurrence data, named after it with the suffixes in
+    WEIGHTING_COLUMN_SUFFIXES. They have one entry per stored row, chunked
+    the same way, and are tagged with the x_max and alpha they were computed
+    for. Does nothing if the file already holds columns for the same values.
+    :param filepath: Path to the HDF5 file written by CoOccurrenceEntries.
+    :param dataset_name: Name of the co-occurrence data in the file.
+    :param x_max: See GloVe.
+    :param alpha: See GloVe.
+    :param compression: Optional chunk compression filter, "gzip" or "lzf".
+    :return:
+    """
+    with h5py.File(filepath, "r+") as file:
+        dataset = file[dataset_name]
+        if isinstance(dataset, h5py.Group):
+            values = dataset["value"]
+        else:
+            values = dataset
+        length = values.shape[0]
+
+        columns = list()
+        for suffix in WEIGHTING_COLUMN_SUFFIXES:
+            name = f"{dataset_name}{suffix}"
+            if name in file:
+                if (file[name].attrs.get("x_max") == x_max
+                        and file[name].attrs.get("alpha") == alpha):
+                    columns.append(None)
+                    continue
+                del file[name]
+            columns.append(file.create_dataset(
+                name,
+                (length,),
+                dtype="f4",
+                chunks=(values.chunks[0],) if length else None,
+                compression=compression
+            ))
+        if all(column is None for column in columns):
+            return
+
+        for chunk in values.iter_chunks() if length else []:
+            rows = chunk[0]
+            if values.ndim == 2:
+                co_occurr_counts = values[rows, 2]
+            else:
+                co_occurr_counts = values[rows]
+            for column, data in zip(
+                    columns,
+                    get_weighting_columns(co_occurr_counts, x_max, alpha)
+            ):
+                if column is not None:
+                    column[rows] = data
+        # Only tag the columns once they are complete.
+        for column in columns:
+            if column is not None:
+                column.attrs["x_max"] = x_max
+                column.attrs["alpha"] = alpha
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import sys
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class MetricsRecorder:
+    """
+    Records how long each phase of a pipeline takes and how many items it
+    processes, and writes them as one JSON object per line to a file each
+    time emit is called. If filepath is None, recording is disabled and
+    every method returns immediately.
+    Timings are wall-clock times measured on the host, so on a GPU they
+    include time spent waiting for queued kernels rather than the kernels
+    themselves.
+    """
+
+    def __init__(self, filepath: str | None = None):
+        self.filepath = filepath
+        self.enabled = filepath is not None
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start_time = time.perf_counter()
+        self._null_phase = contextlib.nullcontext()
+
+    # Context manager adding the time spent inside it to the phase name.
+    def phase(self, name: str):
+        if not self.enabled:
+            return self._null_phase
+        return self._timed_phase(name)
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    # Adds n to the number of items called name that were processed.
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            self.counts[name] += n
+
+    # Adds timings and counts recorded elsewhere, e.g. by another process,
+    # to those of this recorder.
+    def merge(self, timings: dict, counts: dict) -> None:
+        if not self.enabled:
+            return
+        for name, seconds in timings.items():
+            self.timings[name] += seconds
+        for name, n in counts.items():
+            self.counts[name] += n
+
+    def emit(self, event: str, **fields) -> None:
+        """
+        Appends a record to the metrics file, then resets the timings and
+        counts. The record holds the time spent in each phase and the number
+        and rate of each kind of item since the last record, the peak
+        resident set size of the process so far, and any extra fields.
+        :param event: Name of what the record describes, e.g. "epoch".
+        :param fields: Extra JSON serializable values to record.
+        :return:
+        """
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        record = {
+            "event": event,
+            "timestamp": time.time(),
+            "elapsed_seconds": elapsed,
+            "phase_seconds": dict(self.timings),
+            "counts": dict(self.counts),
+            "per_second": {
+                name: count / elapsed if elapsed > 0 else None
+                for name, count in self.counts.items()
+            },
+            "peak_rss_bytes": get_peak_rss(),
+            **fields
+        }
+        with open(self.filepath, "a") as file:
+            file.write(json.dumps(record) + "\n")
+        self.reset()
+
+    # Discards the timings and counts recorded since the last record, and
+    # restarts the clock that item rates are measured against.
+    def reset(self) -> None:
+        self.timings.clear()
+        self.counts.clear()
+        self.start_time = time.perf_counter()
+
+
+# Returns the peak resident set size of this process in bytes, or None if
+# it can't be measured on this platform.
+def get_peak_rss() -> int | None:
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return peak_rss
+    return peak_rss * 1024
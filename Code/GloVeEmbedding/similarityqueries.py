@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SimilarityQueries:
+    """
+    Answers cosine similarity, analogy and most similar word queries over
+    word vectors in batches. The vectors are L2-normalized once, as float32,
+    so every batch of queries is answered with a single matrix multiply.
+    The results of most_similar are cached per word, up to cache_size
+    words, evicting the least recently used.
+    :param vectors: A (V, d) array, e.g. weight + weight_tilde of a trained
+    GloVe model.
+    :param tokens: The token of each row of vectors.
+    :param cache_size: Number of words whose neighbours are cached.
+    """
+
+    def __init__(
+            self,
+            vectors: np.ndarray,
+            tokens: list[str],
+            cache_size: int = 4096
+    ):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        self.tokens = list(tokens)
+        self.token2index = {token: index for index, token in
+                            enumerate(self.tokens)}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    # Returns the rows of the given tokens, raising a KeyError naming the
+    # first one that has no vector.
+    def get_indices(self, tokens: list[str]) -> np.ndarray:
+        try:
+            return np.array(
+                [self.token2index[token] for token in tokens],
+                dtype=np.int64
+            )
+        except KeyError as error:
+            raise KeyError(f"Token {error.args[0]!r} has no vector.") \
+                from None
+
+    def similarity(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        """
+        Equivalent of KeyedVectors.similarity for many pairs of words.
+        :param pairs: The pairs of words to compare.
+        :return: The cosine similarity of each pair.
+        """
+        if not pairs:
+            return np.zeros(0, dtype=np.float32)
+        first, second = zip(*pairs)
+        return np.einsum(
+            "ij,ij->i",
+            self.vectors[self.get_indices(first)],
+            self.vectors[self.get_indices(second)]
+        )
+
+    def most_similar(
+            self,
+            words: list[str],
+            k: int = 10
+    ) -> list[list[tuple[str, float]]]:
+        """
+        Equivalent of KeyedVectors.similar_by_word for many words.
+        :param words: The words to find the neighbours of.
+        :param k: Number of neighbours to return for each word.
+        :return: For each word, the k other words most similar to it, with
+        their cosine similarities, most similar first.
+        """
+        results = {}
+        missing = []
+        for word in dict.fromkeys(words):
+            cached = self._cache.get((word, k))
+            if cached is None:
+                missing.append(word)
+            else:
+                self._cache.move_to_end((word, k))
+                results[word] = cached
+
+        if missing:
+            indices = self.get_indices(missing)
+            neighbours = self._top_k(self.vectors[indices], k, indices[:, None])
+            for word, word_neighbours in zip(missing, neighbours):
+                results[word] = word_neighbours
+                self._cache[(word, k)] = word_neighbours
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return [results[word] for word in words]
+
+    def analogy(
+            self,
+            analogies: list[tuple[str, str, str]],
+            k: int = 1
+    ) -> list[list[tuple[str, float]]]:
+        """
+        Solves analogies a : b :: c : ? by finding the words most similar to
+        b - a + c, as KeyedVectors.most_similar(positive=[b, c],
+        negative=[a]) does.
+        :param analogies: The (a, b, c) triples of words.
+        :param k: Number of answers to return for each analogy.
+        :return: For each analogy, the k words other than a, b and c most
+        similar to b - a + c, with their cosine similarities.
+        """
+        if not analogies:
+            return []
+        a, b, c = (self.get_indices(words) for words in zip(*analogies))
+        queries = self.vectors[b] - self.vectors[a] + self.vectors[c]
+        queries /= np.maximum(
+            np.linalg.norm(queries, axis=1, keepdims=True),
+            np.finfo(np.float32).tiny
+        )
+        return self._top_k(queries, k, np.stack([a, b, c], axis=1))
+
+    # Returns the k words most similar to each query vector, leaving out the
+    # rows in the same row of excluded.
+    def _top_k(
+            self,
+            queries: np.ndarray,
+            k: int,
+            excluded: np.ndarray
+    ) -> list[list[tuple[str, float]]]:
+        scores = queries @ self.vectors.T
+        np.put_along_axis(scores, excluded, -np.inf, axis=1)
+        k = min(k, scores.shape[1] - excluded.shape[1])
+        if k <= 0:
+            return [[] for _ in queries]
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [
+            [(self.tokens[index], float(score))
+             for index, score in zip(row, row_scores)]
+            for row, row_scores in zip(best.tolist(), best_scores.tolist())
+        ]
@@ -1,21 +1,27 @@
 import argparse
-import pickle
+import contextlib
 import os
+import pickle
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from nltk.tokenize import word_tokenize
 
 import yaml
 import matplotlib.pyplot as plt
 import torch
+import torch.multiprocessing
 import torch.optim
 from tqdm import tqdm
 
-from vectorizer import Vectorizer
+from checkpoint import load_checkpoint, save_checkpoint, should_stop_early
+from corpuscache import load_vectorized_corpus
 from cooccurrenceentries import CoOccurrenceEntries
+from embeddingbundle import export_embeddings
+from fusedadagrad import FusedAdagrad
 from glove import GloVe
-from hdf5dataloader import HDF5DataLoader
+from hdf5dataloader import HDF5DataLoader, add_weighting_columns
+from metrics import MetricsRecorder
 
 
 def parse_args():
@@ -30,6 +36,11 @@ def parse_args():
         help="train the word vectors given the cooccurrence matrix",
         action="store_true"
     )
+    parser.add_argument(
+        "--resume",
+        help="resume training from the checkpoint in the config, if any",
+        action="store_true"
+    )
     return parser.parse_args()
 
 
@@ -44,37 +55,43 @@ def load_config():
 
 
 def calculate_cooccurrence(config):
-    try:
-        with open("enwik8.pickle", 'rb') as f:
-            corpus = pickle.load(f)
-    except FileNotFoundError:
-        with open(config.input_filepath, "r") as f:
-            corpus = word_tokenize(f.read())
-        with open("enwik8.pickle", 'wb') as f:
-            pickle.dump(corpus, f)
-    vectorizer = Vectorizer.from_corpus(
-        corpus=corpus,
-        vocab_size=config.vocab_size
-    )
-    cooccurrence = CoOccurrenceEntries.setup(
-        corpus=corpus,
+    metrics = MetricsRecorder(config.metrics_filepath)
+    # Tokenizing and vectorizing the input file is cached, so re-running with
+    # different co-occurrence settings skips straight to the build.
+    with metrics.phase("vectorize_corpus"):
+        vectorizer, vectorized_corpus = load_vectorized_corpus(
+            input_filepath=config.input_filepath,
+            cache_directory=config.corpus_cache_dir,
+            vocab_size=config.vocab_size,
+            streaming=config.streaming,
+            chunk_size=config.stream_chunk_size,
+            num_workers=config.num_workers,
+            seed=config.seed
+        )
+    cooccurrence = CoOccurrenceEntries(
+        vectorized_corpus=vectorized_corpus,
         vectorizer=vectorizer
     )
-    cooccurrence.build(
-        window_size=config.window_size,
-        num_partitions=config.num_partitions,
-        chunk_size=config.chunk_size,
-        output_directory=config.cooccurrence_dir
-    )
+    with metrics.phase("build"):
+        num_entries = cooccurrence.build(
+            window_size=config.window_size,
+            num_partitions=config.num_partitions,
+            chunk_size=config.chunk_size,
+            output_directory=config.cooccurrence_dir,
+            mode=config.build_mode,
+            num_workers=config.num_workers,
+            block_size=config.block_size,
+            format_version=config.cooccurrence_format_version,
+            compression=config.cooccurrence_compression,
+            symmetric=config.symmetric
+        )
+    metrics.count("corpus_tokens", len(vectorized_corpus))
+    metrics.count("cooccurrence_entries", num_entries)
+    metrics.emit("cooccurrence", build_mode=config.build_mode)
 
 
-def train_glove(config):
-    dataloader = HDF5DataLoader(
-        filepath=os.path.join(config.cooccurrence_dir, "cooccurrence.hdf5"),
-        dataset_name="cooccurrence",
-        batch_size=config.batch_size,
-        device=config.device
-    )
+def train_glove(config, resume=False):
+    metrics = MetricsRecorder(config.metrics_filepath)
     model = GloVe(
         vocab_size=config.vocab_size,
         embedding_size=config.embedding_size,
@@ -82,36 +99,254 @@ def train_glove(config):
         alpha=config.alpha
     )
     model.to(config.device)
-    optimizer = torch.optim.Adagrad(
-        model.parameters(),
-        lr=config.learning_rate
-    )
-    with dataloader.open():
-        model.train()
-        losses = []
-        for epoch in tqdm(range(config.num_epochs)):
-            epoch_loss = 0
-            for batch in tqdm(dataloader.iter_batches()):
-                loss = model(
-                    batch[0][:, 0],
-                    batch[0][:, 1],
-                    batch[1]
-                )
-                epoch_loss += loss.detach().item()
-                loss.backward()
-                optimizer.step()
-                optimizer.zero_grad()
+    if config.fused_step:
+        optimizer = FusedAdagrad(model, lr=config.learning_rate)
+    else:
+        optimizer = torch.optim.Adagrad(
+            model.parameters(),
+            lr=config.learning_rate
+        )
+    if config.precompute_weighting:
+        # Store log(x) and the weighting in the cooccurrence file, so that
+        # they aren't computed again for every batch of every epoch.
+        add_weighting_columns(
+            filepath=_get_cooccurrence_filepath(config),
+            dataset_name="cooccurrence",
+            x_max=config.x_max,
+            alpha=config.alpha
+        )
+    start_epoch = 0
+    losses = []
+    if resume and config.checkpoint_filepath is not None \
+            and os.path.exists(config.checkpoint_filepath):
+        start_epoch, losses = load_checkpoint(
+            config.checkpoint_filepath,
+            model,
+            optimizer
+        )
+        print(f"Resuming from epoch {start_epoch}")
+
+    model.train()
+    with contextlib.ExitStack() as stack:
+        if config.num_train_workers > 1:
+            run_epoch = _setup_hogwild(config, model, optimizer, metrics)
+        else:
+            dataloader = _get_dataloader(config, metrics=metrics)
+            stack.enter_context(dataloader.open())
 
+            def run_epoch():
+                return _train_epoch(model, optimizer, dataloader, metrics)
+
+        # Separates the cost of loading data and starting workers from the
+        # first epoch.
+        metrics.emit("train_setup")
+        for epoch in tqdm(range(start_epoch, config.num_epochs)):
+            epoch_loss = run_epoch()
             losses.append(epoch_loss)
             print(f"Epoch {epoch}: loss = {epoch_loss}")
+            metrics.emit("epoch", epoch=epoch, loss=epoch_loss)
             torch.save(model.state_dict(), config.output_filepath)
 
+            stop = config.early_stopping_min_improvement is not None \
+                and should_stop_early(
+                    losses,
+                    config.early_stopping_min_improvement,
+                    config.early_stopping_patience
+                )
+            if config.checkpoint_filepath is not None and (
+                    (epoch + 1) % config.checkpoint_interval == 0
+                    or epoch + 1 == config.num_epochs
+                    or stop
+            ):
+                save_checkpoint(
+                    config.checkpoint_filepath,
+                    model,
+                    optimizer,
+                    epoch,
+                    losses
+                )
+            if stop:
+                print(f"Stopping early: loss improved by less than "
+                      f"{config.early_stopping_min_improvement:.2%} in the "
+                      f"last {config.early_stopping_patience} epochs.")
+                break
+
+    if config.export_directory is not None:
+        _export_embeddings(config, model, losses)
+
     plt.plot(losses)
     plt.xlabel("Epoch")
     plt.ylabel("Loss")
     plt.show()
 
 
+# Writes weight + weight_tilde, the vectors used for similarity queries, as
+# an embedding bundle that can be loaded without torch.
+def _export_embeddings(config, model, losses):
+    with open(_get_vocab_filepath(config), "rb") as file:
+        vocab = pickle.load(file)
+    export_embeddings(
+        config.export_directory,
+        vectors=(model.weight.weight.detach()
+                 + model.weight_tilde.weight.detach()).cpu().numpy(),
+        tokens=[vocab.get_token(index) for index in range(config.vocab_size)],
+        vectors_are="weight + weight_tilde",
+        x_max=config.x_max,
+        alpha=config.alpha,
+        num_epochs=len(losses),
+        final_loss=losses[-1] if losses else None
+    )
+    print(f"Exported embeddings to {config.export_directory}")
+
+
+def _get_dataloader(config, shard=0, num_shards=1, metrics=None):
+    weighted_batches = config.fused_step or config.precompute_weighting
+    return HDF5DataLoader(
+        filepath=_get_cooccurrence_filepath(config),
+        dataset_name="cooccurrence",
+        batch_size=config.batch_size,
+        device=config.device,
+        prefetch=config.prefetch,
+        shard=shard,
+        num_shards=num_shards,
+        # The fused step needs log(x) and the weighting with each batch.
+        x_max=config.x_max if weighted_batches else None,
+        alpha=config.alpha if weighted_batches else None,
+        metrics=metrics or MetricsRecorder()
+    )
+
+
+def _get_cooccurrence_filepath(config):
+    return os.path.join(config.cooccurrence_dir, "cooccurrence.hdf5")
+
+
+def _get_vocab_filepath(config):
+    return os.path.join(config.cooccurrence_dir, "vocab.pkl")
+
+
+def _train_epoch(
+        model,
+        optimizer,
+        dataloader,
+        metrics=None,
+        progress=True
+):
+    metrics = metrics or MetricsRecorder()
+    epoch_loss = 0
+    batches = iter(tqdm(dataloader.iter_batches(), disable=not progress))
+    while True:
+        # Time spent waiting on the dataloader for the next batch.
+        with metrics.phase("next_batch"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        metrics.count("batches")
+        metrics.count("cooccurrence_entries", len(batch[1]))
+
+        if isinstance(optimizer, FusedAdagrad):
+            with metrics.phase("fused_step"):
+                epoch_loss += optimizer.step(
+                    batch[0][:, 0],
+                    batch[0][:, 1],
+                    batch[2],
+                    batch[3]
+                )
+            continue
+        with metrics.phase("forward"):
+            # Batches may come with log(x) and the weighting precomputed.
+            loss = model(
+                batch[0][:, 0],
+                batch[0][:, 1],
+                *batch[1:]
+            )
+            epoch_loss += loss.detach().item()
+        with metrics.phase("backward"):
+            loss.backward()
+        with metrics.phase("optimizer_step"):
+            optimizer.step()
+            optimizer.zero_grad()
+    return epoch_loss
+
+
+def _setup_hogwild(config, model, optimizer, metrics):
+    """
+    Prepares to train model with config.num_train_workers processes updating
+    the same parameters and optimizer state without locks, as in the
+    reference GloVe implementation. Each worker trains on its own share of
+    the rows of every chunk of the co-occurrence file, and the workers are
+    joined at the end of each epoch to record the loss and save the model.
+    The timings and counts of the workers are summed into metrics. CPU
+    only.
+    :return: A function training one epoch, and returning its loss summed
+    over workers.
+    """
+    if str(config.device) != "cpu":
+        raise ValueError(
+            "Multiple training workers are only supported on CPU."
+        )
+    model.share_memory()
+    optimizer.share_memory()
+    num_workers = config.num_train_workers
+    worker_losses = torch.zeros(num_workers).share_memory_()
+    # Each worker puts the timings and counts it recorded.
+    worker_metrics = torch.multiprocessing.SimpleQueue()
+
+    def run_epoch():
+        # Drawn anew each epoch, so that the workers, which would otherwise
+        # all start from the parent's random state, shuffle differently from
+        # each other and from one epoch to the next.
+        epoch_seed = np.random.randint(2 ** 31)
+        workers = [
+            torch.multiprocessing.Process(
+                target=_hogwild_worker,
+                args=(rank, epoch_seed, config, model, optimizer,
+                      worker_losses, worker_metrics)
+            )
+            for rank in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                raise RuntimeError(
+                    f"Training worker exited with code {worker.exitcode}."
+                )
+        while not worker_metrics.empty():
+            metrics.merge(*worker_metrics.get())
+        return worker_losses.sum().item()
+
+    return run_epoch
+
+
+def _hogwild_worker(rank, epoch_seed, config, model, optimizer,
+                    worker_losses, worker_metrics):
+    # Each worker is one of many sharing the machine's cores.
+    torch.set_num_threads(1)
+    # Seeds the chunk order and the order of the entries of each chunk.
+    np.random.seed([epoch_seed, rank])
+    torch.manual_seed(np.random.randint(2 ** 31))
+    # Records, but never emits: the parent merges and emits the records of
+    # all workers.
+    metrics = MetricsRecorder(config.metrics_filepath)
+    dataloader = _get_dataloader(
+        config,
+        rank,
+        config.num_train_workers,
+        metrics
+    )
+    with dataloader.open():
+        worker_losses[rank] = _train_epoch(
+            model,
+            optimizer,
+            dataloader,
+            metrics,
+            progress=rank == 0
+        )
+    if metrics.enabled:
+        worker_metrics.put((dict(metrics.timings), dict(metrics.counts)))
+
+
 def main():
     print(f"Started: {pd.Timestamp.now()}")
 
@@ -120,7 +355,7 @@ def main():
     if not args.second_step_only:
         calculate_cooccurrence(config)
     if not args.first_step_only:
-        train_glove(config)
+        train_glove(config, resume=args.resume)
 
     print(f"Completed: {pd.Timestamp.now()}")
 
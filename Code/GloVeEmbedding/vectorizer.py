@@ -1,7 +1,15 @@
 from __future__ import annotations
 
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor
 from dataclasses import dataclass
 
+import numpy as np
+from nltk.tokenize import word_tokenize
+
+from atomicwrite import atomic_write
+from corpusstream import iter_text_chunks, iter_token_chunks
 from vocabulary import Vocabulary
 
 
@@ -18,26 +26,117 @@ class Vectorizer:
     # Takes a corpus, builds a Vocabulary from it, then constructs and
     # returns a Vectorizer constructed with a Vocabulary containing the most
     # frequently occurring vocab_size words in the base Vocabulary.
+    # The tokens are counted in a single process: sending them to worker
+    # processes and merging the results costs about as much as counting
+    # them, so only from_file gains from workers. seed is passed to
+    # Vocabulary.shuffle.
     @classmethod
     def from_corpus(
             cls,
             corpus: list[str],
-            vocab_size: int = None
+            vocab_size: int = None,
+            seed: int | None = None
+    ) -> Vectorizer:
+        return cls._from_counted_vocab(_count_tokens(corpus), vocab_size, seed)
+
+    # Builds a Vectorizer the same way as from_corpus, but from a text file
+    # that is tokenized and counted a chunk at a time (see
+    # corpusstream.iter_token_chunks), so memory use depends on the size of
+    # the vocabulary rather than the size of the corpus.
+    # With num_workers > 1, chunks are tokenized and counted in separate
+    # processes, at most two per worker being held in memory at once.
+    @classmethod
+    def from_file(
+            cls,
+            filepath: str,
+            vocab_size: int = None,
+            chunk_size: int = 10_000_000,
+            num_workers: int = 1,
+            seed: int | None = None
+    ) -> Vectorizer:
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                vocab = _merge_vocabularies(_map_bounded(
+                    executor,
+                    _count_text,
+                    iter_text_chunks(filepath, chunk_size),
+                    2 * num_workers
+                ))
+        else:
+            vocab = Vocabulary()
+            for tokens in iter_token_chunks(filepath, chunk_size):
+                vocab.update(tokens)
+        return cls._from_counted_vocab(vocab, vocab_size, seed)
+
+    # If vocab_size is not specified as an integer, then return complete
+    # Vocabulary. Otherwise, return a vocabulary consisting of the
+    # vocab_size most frequently occurring tokens. Either way, shuffled.
+    @classmethod
+    def _from_counted_vocab(
+            cls,
+            vocab: Vocabulary,
+            vocab_size: int | None,
+            seed: int | None
     ) -> Vectorizer:
-        vocab = Vocabulary()
-        for token in corpus:
-            vocab.add(token)
-        # If vocab_size is not specified as an integer, then return complete
-        # Vocabulary. Otherwise, return a vocabulary consisting of the
-        # vocab_size most frequently occurring tokens.
         if vocab_size is not None:
             vocab = vocab.get_topk_subset(vocab_size)
-        vocab.shuffle()
+        vocab.shuffle(seed)
         return cls(vocab)
 
+    # Tokenizes a text file a chunk at a time, and writes the vectorized
+    # tokens to output_filepath as a flat array of int32. Returns a read-only
+    # memory map of that array, which can be used as the vectorized corpus
+    # of a CoOccurrenceEntries instance.
+    def vectorize_file(
+            self,
+            filepath: str,
+            output_filepath: str,
+            chunk_size: int = 10_000_000
+    ) -> np.memmap:
+        with atomic_write(output_filepath) as file:
+            for tokens in iter_token_chunks(filepath, chunk_size):
+                self.vectorize(tokens).tofile(file)
+        return np.memmap(output_filepath, dtype=np.int32, mode="r")
+
     # takes a corpus and returns a version in which the words in Vocabulary
     # have been replaced with their indices, and words not in Vocabulary have
     # been replaced with the value used to specify words not in Vocabulary -
     # 'unknown' words.
-    def vectorize(self, corpus: list[str]) -> list[int]:
-        return [self.vocab[token] for token in corpus]
\ No newline at end of file
+    def vectorize(self, corpus: list[str]) -> np.ndarray:
+        return self.vocab.encode(corpus)
+
+
+def _count_tokens(tokens: list[str]) -> Vocabulary:
+    vocab = Vocabulary()
+    vocab.update(tokens)
+    return vocab
+
+
+def _count_text(text: str) -> Vocabulary:
+    return _count_tokens(word_tokenize(text))
+
+
+# Merges Vocabularies counted from consecutive shards of a corpus, in order.
+def _merge_vocabularies(vocabs: Iterable[Vocabulary]) -> Vocabulary:
+    merged = Vocabulary()
+    for vocab in vocabs:
+        merged.merge(vocab)
+    return merged
+
+
+# Like executor.map, but submits at most max_pending items at a time, so
+# that a long iterable isn't read into memory all at once. Results are
+# yielded in order.
+def _map_bounded(
+        executor: Executor,
+        fn: Callable,
+        iterable: Iterable,
+        max_pending: int
+) -> Iterator:
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -1,56 +1,125 @@
 from __future__ import annotations
 
+from collections import Counter
 from dataclasses import field, dataclass
+from itertools import repeat
 
 import numpy as np
 
 
-@dataclass
+@dataclass(eq=False)
 class Vocabulary:
     """
     Stores all the unique tokens occurring in a corpus, along with counts of
     the number of times they occur. Includes useful accessors and mutators,
     and methods for shuffling order of data and obtaining subsets of the most
     frequently occurring tokens of arbitrary size as new Vocabulary objects.
+    Tokens and counts are stored in NumPy arrays indexed by token index, so
+    that subsets, shuffling and encoding are array operations. The arrays
+    have spare capacity that grows by doubling, so that adding tokens one at
+    a time takes amortized constant time.
     """
     # To get index from token
     token2index: dict = field(default_factory=dict)
-    # To get token from index
-    index2token: dict = field(default_factory=dict)
-    # todo: convert token_counts to dictionary
-    # Number of occurrence of tokens by index (should be a dictionary)
-    token_counts: list = field(default_factory=list)
+    # Token by index, for the first len(self) entries. See index2token.
+    _index2token: np.ndarray = field(
+        init=False,
+        repr=False,
+        default_factory=lambda: np.empty(0, dtype=object)
+    )
+    # Number of occurrence of tokens by index, for the first len(self)
+    # entries. See token_counts.
+    _token_counts: np.ndarray = field(
+        init=False,
+        repr=False,
+        default_factory=lambda: np.zeros(0, dtype=np.int64)
+    )
     # Value used to specify unknown tokens
     _unk_token: int = field(init=False, default=-1)
 
-    # Tell Vocabulary object it has encountered a new token.
-    # If novel, add to lookup dictionaries and token_counts.
+    # Returns a Vocabulary containing the tokens in index2token, in that
+    # order, with the associated counts.
+    @classmethod
+    def from_arrays(
+            cls,
+            index2token: np.ndarray,
+            token_counts: np.ndarray
+    ) -> Vocabulary:
+        vocab = cls(
+            token2index=dict(zip(index2token, range(len(index2token))))
+        )
+        vocab.index2token = index2token
+        vocab.token_counts = token_counts
+        return vocab
+
+    # To get token from index. A view of the first len(self) entries of the
+    # underlying array, which is replaced when it grows.
+    @property
+    def index2token(self) -> np.ndarray:
+        return self._index2token[:len(self)]
+
+    @index2token.setter
+    def index2token(self, index2token: np.ndarray) -> None:
+        self._index2token = np.asarray(index2token, dtype=object)
+
+    # Number of occurrence of tokens by index. A view, as for index2token.
+    @property
+    def token_counts(self) -> np.ndarray:
+        return self._token_counts[:len(self)]
+
+    @token_counts.setter
+    def token_counts(self, token_counts: np.ndarray) -> None:
+        self._token_counts = np.asarray(token_counts, dtype=np.int64)
+
+    # Tell Vocabulary object it has encountered a new token, count times.
+    # If novel, add to lookup dictionary and arrays.
     # If not novel, just increment appropriate index of token_counts.
-    def add(self, token: str) -> None:
-        if token not in self.token2index:
+    def add(self, token: str, count: int = 1) -> None:
+        index = self.token2index.get(token)
+        if index is None:
             index = len(self)
+            self._reserve(index + 1)
+            self._index2token[index] = token
             self.token2index[token] = index
-            self.index2token[index] = token
-            self.token_counts.append(0)
-        self.token_counts[self.token2index[token]] += 1
+        self._token_counts[index] += count
+
+    # Adds every token in tokens. Tokens are indexed in order of first
+    # occurrence, exactly as if each had been passed to add in turn.
+    def update(self, tokens: list[str]) -> None:
+        counts = Counter(tokens)
+        self._append_novel(counts)
+        self.token_counts[self.encode(counts)] += np.fromiter(
+            counts.values(),
+            dtype=np.int64,
+            count=len(counts)
+        )
+
+    # Adds the tokens and counts of other, a Vocabulary counted from another
+    # part of the same corpus. Merging the Vocabularies of consecutive shards
+    # in order indexes tokens exactly as counting the whole corpus would.
+    def merge(self, other: Vocabulary) -> None:
+        self._append_novel(other.index2token)
+        self.token_counts[self.encode(other.index2token)] += other.token_counts
 
     # Returns a new Vocabulary object containing only the k most frequently
     # occurring tokens, along with their counts in the original Vocabulary.
+    # Tokens with equal counts keep their relative order.
     def get_topk_subset(self, k: int) -> Vocabulary:
-        tokens = sorted(
-            list(self.token2index.keys()),
-            key=lambda token: self.token_counts[self[token]],
-            reverse=True
-        )
-        return Vocabulary(
-            token2index={token: index for index, token in
-                         enumerate(tokens[:k])},
-            index2token={index: token for index, token in
-                         enumerate(tokens[:k])},
-            token_counts=[
-                self.token_counts[self.token2index[token]] for token in
-                tokens[:k]
-            ]
+        if k < len(self):
+            # Count of the k-th most frequent token. Every token above it is
+            # kept, along with the first of the tokens tied with it.
+            kth_count = -np.partition(-self.token_counts, k - 1)[k - 1]
+            above = np.flatnonzero(self.token_counts > kth_count)
+            tied = np.flatnonzero(self.token_counts == kth_count)
+            indices = np.concatenate([above, tied[:k - len(above)]])
+        else:
+            indices = np.arange(len(self))
+        indices = indices[
+            np.argsort(-self.token_counts[indices], kind="stable")
+        ]
+        return Vocabulary.from_arrays(
+            self.index2token[indices],
+            self.token_counts[indices]
         )
 
     # Randomizes the order in which tokens are stored. Useful because in
@@ -59,15 +128,30 @@ class Vocabulary:
     # generates uniform density - useful for co-occurrence matrix
     # construction, where matrix can become extremely large and may need to
     # be processed in segments.
-    def shuffle(self) -> None:
-        new_index = [i for i in range(len(self))]
-        np.random.shuffle(new_index)
-        new_token_counts = [None] * len(self)
-        for token, index in zip(list(self.token2index.keys()), new_index):
-            new_token_counts[index] = self.token_counts[self[token]]
-            self.token2index[token] = index
-            self.index2token[index] = token
-        self.token_counts = new_token_counts
+    # If seed is given, the order only depends on it, otherwise it comes from
+    # NumPy's global random state.
+    def shuffle(self, seed: int | None = None) -> None:
+        # new_index[i] is the index that the token at index i moves to.
+        if seed is None:
+            new_index = np.random.permutation(len(self))
+        else:
+            new_index = np.random.default_rng(seed).permutation(len(self))
+        index2token = np.empty_like(self.index2token)
+        index2token[new_index] = self.index2token
+        token_counts = np.empty_like(self.token_counts)
+        token_counts[new_index] = self.token_counts
+        self.index2token = index2token
+        self.token_counts = token_counts
+        self.token2index = dict(zip(index2token, range(len(index2token))))
+
+    # Returns the indices of tokens as an array, using the value associated
+    # with unknown tokens for tokens not in Vocabulary.
+    def encode(self, tokens) -> np.ndarray:
+        return np.fromiter(
+            map(self.token2index.get, tokens, repeat(self._unk_token)),
+            dtype=np.int32,
+            count=len(tokens)
+        )
 
     # Returns index of token.
     def get_index(self, token: str) -> int:
@@ -75,7 +159,7 @@ class Vocabulary:
 
     # Returns token at index
     def get_token(self, index: int) -> str:
-        if not index in self.index2token:
+        if not 0 <= index < len(self):
             raise IndexError("Invalid index.")
         return self.index2token[index]
 
@@ -84,6 +168,56 @@ class Vocabulary:
     def unk_token(self) -> int:
         return self._unk_token
 
+    # Appends the tokens not yet in Vocabulary, with counts of zero.
+    def _append_novel(self, tokens) -> None:
+        novel = [token for token in tokens if token not in self.token2index]
+        if not novel:
+            return
+        start = len(self)
+        self._reserve(start + len(novel))
+        self._index2token[start:start + len(novel)] = novel
+        for index, token in enumerate(novel, start=start):
+            self.token2index[token] = index
+
+    # Grows the arrays to hold at least size tokens, at least doubling their
+    # capacity. The new entries have no token and a count of zero.
+    def _reserve(self, size: int) -> None:
+        capacity = len(self._index2token)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        index2token = np.empty(capacity, dtype=object)
+        index2token[:len(self)] = self.index2token
+        token_counts = np.zeros(capacity, dtype=np.int64)
+        token_counts[:len(self)] = self.token_counts
+        self._index2token = index2token
+        self._token_counts = token_counts
+
+    # Vocabularies are equal if they hold the same tokens, at the same
+    # indices, with the same counts, whatever their spare capacity.
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Vocabulary):
+            return NotImplemented
+        return self.token2index == other.token2index \
+            and self._unk_token == other._unk_token \
+            and np.array_equal(self.token_counts, other.token_counts)
+
+    # Loads Vocabularies pickled before the arrays had spare capacity, which
+    # stored index2token and token_counts directly, at first as a dict and a
+    # list.
+    def __setstate__(self, state: dict) -> None:
+        state = dict(state)
+        index2token = state.pop("index2token", None)
+        token_counts = state.pop("token_counts", None)
+        self.__dict__.update(state)
+        if index2token is not None:
+            if isinstance(index2token, dict):
+                index2token = [index2token[i] for i in range(len(index2token))]
+            index2token_array = np.empty(len(index2token), dtype=object)
+            index2token_array[:] = index2token
+            self.index2token = index2token_array
+            self.token_counts = token_counts
+
     # Returns index of token IF token is in Vocabulary, else returns value
     # associated with unknown token.
     def __getitem__(self, token: str) -> int:
@@ -1,3 +1,6 @@
 from Code.WordProximityEmbedding import generate_data as gd
 
-gd.generate_data("example_config.json")
+# Books are processed in worker processes when "Number of Workers" is more
+# than 1, which import this module again on platforms that spawn them.
+if __name__ == '__main__':
+    gd.generate_data("example_config.json")
@@ -0,0 +1,130 @@
+"""
+Compares the speed of _tokenize_texts with the implementation it replaced,
+which removed non-alphabetic characters one character at a time and looked
+stop words up in a list, on a full length novel, and checks that both
+produce exactly the same tokens. Run from the root of the repository:
+
+python -m Code.WordProximityEmbedding.benchmark_tokenization
+"""
+import argparse
+import json
+import os
+import time
+
+from nltk.corpus import stopwords as sw
+
+from Code.WordProximityEmbedding import generate_data as gd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--text",
+        help="path of the text to tokenize, with a json file of the same "
+             "name holding its compounding dictionary",
+        default=os.path.join(
+            os.path.dirname(__file__),
+            "input",
+            "The Fellowship of the Ring.txt"
+        )
+    )
+    parser.add_argument(
+        "--repeats",
+        help="number of times to time each implementation, the fastest "
+             "time is reported",
+        type=int,
+        default=3
+    )
+    return parser.parse_args()
+
+
+def _tokenize_texts_reference(
+        config: dict,
+        texts: dict[str, str],
+        compounding_dicts: dict[str, dict[str, str]]
+) -> dict[str, list[str]]:
+    """
+    _tokenize_texts as it was before tokens were cleaned with str.translate
+    and stop words looked up in a frozenset, without pronoun processing.
+    """
+    processed_texts = dict()
+    for title, text in texts.items():
+        if compounding_dicts[title] is not None:
+            for current, replacement in compounding_dicts[title].items():
+                text = text.replace(current, replacement)
+
+        tokenized_text = text.split()
+
+        cleaned_tokenized_text = list()
+        for token in tokenized_text:
+            cleaned_token = ''.join(c for c in token if c.isalpha())
+            if cleaned_token != '':
+                cleaned_tokenized_text.append(cleaned_token.lower())
+
+        if config["Remove Stop Words"]:
+            stopwords = sw.words('english')
+            cleaned_stopwords = list()
+            for word in stopwords:
+                cleaned_word = ''.join(c for c in word if c.isalpha())
+                cleaned_stopwords.append(cleaned_word)
+            cleaned_tokenized_text = (
+                [w for w in cleaned_tokenized_text
+                 if w not in cleaned_stopwords]
+            )
+
+        processed_texts[title] = cleaned_tokenized_text
+    return processed_texts
+
+
+def _time(function, repeats: int, *args) -> tuple[float, dict]:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    args = parse_args()
+    gd._download_nltk_data()
+    title = os.path.basename(args.text)[:-4]
+    with open(args.text, 'r') as file:
+        texts = {title: file.read().lower()}
+    with open(f"{args.text[:-4]}.json", 'r') as file:
+        compounding_dicts = {title: json.load(file)['compounding_dict']}
+    print(f"{title}: {len(texts[title].split())} tokens")
+
+    for remove_stop_words in [False, True]:
+        config = {
+            "Remove Stop Words": remove_stop_words,
+            "Process Pronouns": False
+        }
+        reference_time, reference = _time(
+            _tokenize_texts_reference,
+            args.repeats,
+            config,
+            texts,
+            compounding_dicts
+        )
+        new_time, result = _time(
+            gd._tokenize_texts,
+            args.repeats,
+            config,
+            texts,
+            compounding_dicts
+        )
+        if result != reference:
+            raise AssertionError(
+                "_tokenize_texts doesn't produce the same tokens as the "
+                "reference implementation."
+            )
+        print(
+            f"Remove Stop Words = {remove_stop_words}: "
+            f"{reference_time:.3f}s -> {new_time:.3f}s "
+            f"({reference_time / new_time:.1f}x faster), identical output"
+        )
+
+
+if __name__ == '__main__':
+    main()
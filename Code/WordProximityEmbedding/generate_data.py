@@ -1,24 +1,24 @@
 from __future__ import annotations
 
+import contextlib
+import hashlib
 import json
 import os
+import re
+import warnings
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO
 
 import nltk
+import numpy as np
 import pandas as pd
 from nltk import pos_tag
 from nltk.corpus import stopwords as sw
 
-
-# You can comment out the below after you've run the code once. It saves
-# files the nltk library needs in an nltk specific directory in your home
-# directory. If you don't like having that directory there, you can just
-# delete it after you've used the nltk library to run some code and it won't
-# cause any problems.
-nltk.download('averaged_perceptron_tagger')
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('tagsets')
-nltk.download('wordnet')
+# Increment when the files written by _pos_tag_cached change, so that older
+# cache entries are no longer used.
+POS_TAG_CACHE_FORMAT_VERSION = 1
 
 
 def main():
@@ -43,12 +43,29 @@ def generate_data(
     with open(config, 'r') as file:
         config = json.load(file)
 
+    _download_nltk_data()
     # Load in the data from the specified input directory
     texts, compounding_dicts, char_names = _load_input_data(config)
-    # Tokenize the input texts
-    tokenized_texts = _tokenize_texts(config, texts, compounding_dicts)
-    # Generate and save embedding data
-    _process_texts(config, tokenized_texts, char_names)
+    # Tokenize, tag and scan each of the input texts
+    book_data = _process_books(config, texts, compounding_dicts, char_names)
+    # Merge and save embedding data
+    _process_texts(config, book_data)
+
+
+# Saves the files the nltk library needs in an nltk specific directory in
+# your home directory. You can comment out the call to this in generate_data
+# after you've run the code once. If you don't like having that directory
+# there, you can just delete it after you've used the nltk library to run
+# some code and it won't cause any problems.
+# Called from generate_data rather than when the module is imported, so that
+# worker processes processing books, which import it again on platforms
+# that spawn them, don't each check for the files too.
+def _download_nltk_data() -> None:
+    nltk.download('averaged_perceptron_tagger')
+    nltk.download('punkt')
+    nltk.download('stopwords')
+    nltk.download('tagsets')
+    nltk.download('wordnet')
 
 
 def _load_input_data(
@@ -205,6 +222,23 @@ def _tokenize_texts(
     :return:
     """
 
+    # Get the set of stop words to remove, if any.
+    stopwords = None
+    if config["Remove Stop Words"]:
+        # But not if we want to work with the pronouns!
+        if config["Process Pronouns"]:
+            raise ValueError(
+                "If you opt to remove stop words, then you can't also "
+                "process pronouns. Removal of stopwords also removes "
+                "pronouns."
+            )
+        # The list of nltk stopwords includes some apostrophes, so we'll
+        # clean those out...
+        stopwords = frozenset(
+            ''.join(c for c in word if c.isalpha())
+            for word in sw.words('english')
+        )
+
     # Create a dictionary to store the results.
     processed_texts = dict()
 
@@ -213,39 +247,23 @@ def _tokenize_texts(
 
         # Make all replacements specified in compounding dictionary for text
         if compounding_dicts[title] is not None:
-            for current, replacement in compounding_dicts[title].items():
-                text = text.replace(current, replacement)
-
-        # Tokenize Text
-        tokenized_text = text.split()
+            text, conflicts = _compound_text(text, compounding_dicts[title])
+            if conflicts:
+                warnings.warn(
+                    f"The result of the compounding dictionary for {title} "
+                    f"depends on the order of its replacements, so the "
+                    f"longest match was replaced wherever they conflict: "
+                    + "; ".join(conflicts)
+                )
 
-        # Remove non-alphanumeric characters and convert to lower case
-        cleaned_tokenized_text = list()
-        for token in tokenized_text:
-            cleaned_token = ''.join(c for c in token if c.isalpha())
-            # Exclude empty tokens...
-            if cleaned_token != '':
-                cleaned_tokenized_text.append(cleaned_token.lower())
+        # Tokenize text, removing non-alphabetic characters and converting
+        # to lower case
+        cleaned_tokenized_text = _clean_and_split(text)
 
         # Optionally Remove stop words
-        if config["Remove Stop Words"]:
-            # But not if we want to work with the pronouns!
-            if config["Process Pronouns"]:
-                raise ValueError(
-                    "If you opt to remove stop words, then you can't also "
-                    "process pronouns. Removal of stopwords also removes "
-                    "pronouns."
-                )
-            stopwords = sw.words('english')
-            # The list of nltk stopwords includes some apostrophes, so we'll
-            # clean those out...
-            cleaned_stopwords = list()
-            for word in stopwords:
-                cleaned_word = ''.join(c for c in word if c.isalpha())
-                cleaned_stopwords.append(cleaned_word)
+        if stopwords is not None:
             cleaned_tokenized_text = (
-                [w for w in cleaned_tokenized_text
-                 if w not in cleaned_stopwords]
+                [w for w in cleaned_tokenized_text if w not in stopwords]
             )
 
         # We could potentially replace pronouns with the most likely nouns
@@ -259,90 +277,554 @@ def _tokenize_texts(
     return processed_texts
 
 
-def _process_texts(
+def _clean_and_split(text: str) -> list[str]:
+    """
+    Splits text into tokens on whitespace, removes every character that
+    isn't alphabetic from each token and converts them to lower case,
+    dropping tokens left empty. Rather than cleaning each token character by
+    character, the non-alphabetic characters are deleted from the whole text
+    with a single str.translate, keeping the whitespace that separates
+    tokens, so tokens made up only of non-alphabetic characters disappear
+    when the text is split.
+    :param text: The text to tokenize.
+    :return:
+    """
+    deleted = {
+        ord(c): None for c in set(text)
+        if not c.isalpha() and not c.isspace()
+    }
+    return text.translate(deleted).lower().split()
+
+
+def _compound_text(
+        text: str,
+        compounding_dict: dict[str, str]
+) -> tuple[str, list[str]]:
+    """
+    Makes all the replacements in compounding_dict in a single pass over
+    text, rather than one pass per replacement. At each position the longest
+    matching key is replaced. The result is the same as calling
+    text.replace(current, replacement) for each item in order, unless
+    replacements conflict, which is reported. Conflicts are looked for in
+    the text around each replacement, with the keys up to its own replaced,
+    so a key only formed once several later replacements have changed the
+    text around it may go unreported.
+    :param text: The text to transform.
+    :param compounding_dict: See _tokenize_texts.
+    :return: The transformed text, and a description of each conflict:
+    a way in which making the replacements one after another in the order
+    of compounding_dict would give a different result for this text.
+    """
+    # Replacing a string with itself never changes the text.
+    replacements = {
+        current: replacement
+        for current, replacement in compounding_dict.items()
+        if current != replacement
+    }
+    conflicts = list()
+    if '' in replacements:
+        conflicts.append("the empty key is ignored")
+        del replacements['']
+    if not replacements:
+        return text, conflicts
+
+    matches = list()
+
+    def replace(match: re.Match) -> str:
+        matches.append(match)
+        return replacements[match.group()]
+
+    pattern = re.compile(_get_trie_pattern(replacements))
+    compounded_text = pattern.sub(replace, text)
+    conflicts += _find_compounding_conflicts(
+        text,
+        replacements,
+        pattern,
+        matches
+    )
+    return compounded_text, conflicts
+
+
+def _get_trie_pattern(keys: Iterable[str]) -> str:
+    """
+    Builds a regular expression matching the longest of keys at any
+    position. Keys are merged into a trie, so that at each position of the
+    text the regex engine follows a single branch instead of trying every
+    key in turn.
+    :param keys: Non-empty strings to match.
+    :return:
+    """
+    trie = dict()
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, dict())
+        # The empty string marks the end of a key.
+        node[''] = True
+
+    def to_pattern(node: dict) -> str:
+        branches = [
+            re.escape(char) + to_pattern(child)
+            for char, child in sorted(node.items())
+            if char != ''
+        ]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = f"(?:{'|'.join(branches)})"
+        # If a key ends here, the greedy ? still tries the longer keys
+        # first.
+        return pattern + '?' if '' in node else pattern
+
+    return to_pattern(trie)
+
+
+def _find_compounding_conflicts(
+        text: str,
+        replacements: dict[str, str],
+        pattern: re.Pattern,
+        matches: list[re.Match]
+) -> list[str]:
+    """
+    Finds where making replacements one after another with str.replace, in
+    order, would not give the same result for text as _compound_text: keys
+    occurring within a longer key found in the text that would be replaced
+    first, replacements of keys found in the text that contain keys replaced
+    after them or form them with the text next to them, once the keys up to
+    their own are replaced there, and keys overlapping one another in the
+    text.
+    :param text: The text before any replacements.
+    :param replacements: The non-empty keys of a compounding dictionary that
+    aren't replaced with themselves, and their replacements.
+    :param pattern: The pattern matching the keys of replacements, see
+    _get_trie_pattern.
+    :param matches: The matches of the keys _compound_text replaced in text.
+    :return: A description of each conflict.
+    """
+    order = {current: i for i, current in enumerate(replacements)}
+    conflicts = list()
+    for current in sorted({match.group() for match in matches}):
+        for other in sorted(_get_substrings(current) & order.keys()):
+            if order[other] < order[current]:
+                conflicts.append(
+                    f"'{other}' is replaced before '{current}', which "
+                    f"contains it"
+                )
+        replacement = replacements[current]
+        for other in sorted(_get_substrings(replacement) & order.keys()):
+            if order[other] > order[current]:
+                conflicts.append(
+                    f"'{current}' is replaced with '{replacement}', which "
+                    f"contains '{other}'"
+                )
+
+    # Any key overlapping a key replaced in the text starts inside it, as
+    # the earlier of two overlapping keys is the one that is replaced.
+    overlaps = dict()
+    for match in matches:
+        for start in range(match.start() + 1, match.end()):
+            other = pattern.match(text, start)
+            if other is not None and other.end() > match.end():
+                overlaps.setdefault(
+                    (match.group(), other.group()),
+                    text[match.start():other.end()]
+                )
+    for (current, other), overlap in sorted(overlaps.items()):
+        conflicts.append(f"'{current}' and '{other}' overlap in '{overlap}'")
+
+    # Keys replaced later that would be found across the edges of a
+    # replacement, e.g. 'strider' -> 'aragorn' followed by
+    # 'aragorn son of arathorn' in 'strider son of arathorn'. The text next
+    # to the replacement is checked as it would be when the replacement is
+    # made one after another: with the keys up to its own replaced, and the
+    # later ones not yet.
+    max_length = max(map(len, replacements))
+    # Matches the longest key starting at every position, without consuming
+    # it, so that overlapping keys are found too.
+    key_starts = re.compile(f"(?=({pattern.pattern}))")
+    # The keys each key starts with, itself included.
+    prefix_keys = {
+        key: [key[:end] for end in range(1, len(key) + 1)
+              if key[:end] in replacements]
+        for key in replacements
+    }
+
+    # Returns the text before or after position, once the keys up to last
+    # are replaced one after another in it. As replacements may shorten it,
+    # it is widened until that leaves at least max_length characters.
+    def get_context(position: int, is_before: bool, last: int) -> str:
+        width = 2 * max_length
+        while True:
+            if is_before:
+                lower, upper = max(position - width, 0), position
+            else:
+                lower, upper = position, min(position + width, len(text))
+            context = _replace_in_order(
+                text[lower:upper],
+                last,
+                replacements,
+                order,
+                prefix_keys,
+                key_starts
+            )
+            if len(context) >= max_length or upper - lower < width:
+                return context
+            width *= 2
+
+    formed = set()
+    for match in matches:
+        current = match.group()
+        before = get_context(match.start(), True, order[current])
+        after = get_context(match.end(), False, order[current])
+        string = before + replacements[current] + after
+        for key_start, key_end in _iter_keys(
+                string,
+                prefix_keys,
+                key_starts,
+                max(len(before) - max_length + 1, 0),
+                len(string) - len(after)
+        ):
+            other = string[key_start:key_end]
+            # Keys within the replacement are found above.
+            if key_end > len(before) and (
+                    key_start < len(before)
+                    or key_end > len(string) - len(after)
+            ) and order[other] > order[current]:
+                formed.add((current, other))
+    for current, other in sorted(formed):
+        conflicts.append(
+            f"'{current}' is replaced with '{replacements[current]}', which "
+            f"forms '{other}' with the text next to it"
+        )
+    return conflicts
+
+
+# Makes the replacements of the keys up to last in order one after
+# another in string, as str.replace would.
+def _replace_in_order(
+        string: str,
+        last: int,
+        replacements: dict[str, str],
+        order: dict[str, int],
+        prefix_keys: dict[str, list[str]],
+        key_starts: re.Pattern
+) -> str:
+    done = -1
+    while True:
+        # Replacing a key may form keys that weren't in string before.
+        pending = {
+            string[key_start:key_end]
+            for key_start, key_end in _iter_keys(
+                string,
+                prefix_keys,
+                key_starts
+            )
+        }
+        pending = [key for key in pending if done < order[key] <= last]
+        if not pending:
+            return string
+        key = min(pending, key=order.get)
+        string = string.replace(key, replacements[key])
+        done = order[key]
+
+
+# Yields the start and end of every occurrence of a key in string that
+# starts at or after pos and before endpos. See _find_compounding_conflicts
+# for prefix_keys and key_starts.
+def _iter_keys(
+        string: str,
+        prefix_keys: dict[str, list[str]],
+        key_starts: re.Pattern,
+        pos: int = 0,
+        endpos: int | None = None
+) -> Iterator[tuple[int, int]]:
+    if endpos is None:
+        endpos = len(string)
+    for key_match in key_starts.finditer(string, pos):
+        key_start = key_match.start()
+        if key_start >= endpos:
+            return
+        for key in prefix_keys[key_match.group(1)]:
+            yield key_start, key_start + len(key)
+
+
+def _get_substrings(string: str) -> set[str]:
+    return {
+        string[start:end]
+        for start in range(len(string))
+        for end in range(start + 1, len(string) + 1)
+    }
+
+
+def _pos_tag_cached(
+        tokenized_text: list[str],
+        cache_directory: str | None
+) -> list[tuple[str, str]]:
+    """
+    Tags tokenized_text with NLTK's pos_tag, reusing the tags stored in
+    cache_directory by a previous run on the same tokens. The cache is
+    content addressed: each file is named after a hash of the tokens and of
+    the tagger version (see _get_pos_tag_cache_key), so settings that don't
+    change the tokens, such as the proximity window, parts of speech or
+    words to exclude, never need the text to be tagged again.
+    Only the tags are stored, as an array of ids into the list of distinct
+    tags, since the tokens are already known.
+    :param tokenized_text: The words of a book in sequence.
+    :param cache_directory: The directory of the cache, created if needed.
+    If None, the text is always tagged.
+    :return: The (word, tag) pairs returned by pos_tag.
+    """
+    if cache_directory is None:
+        return pos_tag(tokenized_text)
+
+    filepath = os.path.join(
+        cache_directory,
+        f"{_get_pos_tag_cache_key(tokenized_text)}.npz"
+    )
+    if os.path.exists(filepath):
+        with np.load(filepath) as arrays:
+            tags = arrays["tags"].tolist()
+            tag_ids = arrays["tag_ids"].tolist()
+        return [(word, tags[i]) for word, i in zip(tokenized_text, tag_ids)]
+
+    ttt = pos_tag(tokenized_text)
+    tags, tag_ids = np.unique(
+        np.array([tag for _, tag in ttt], dtype=str),
+        return_inverse=True
+    )
+    os.makedirs(cache_directory, exist_ok=True)
+    tag_ids = tag_ids.astype(np.uint8 if len(tags) <= 256 else np.uint16)
+    with _atomic_write(filepath) as file:
+        np.savez(file, tags=tags, tag_ids=tag_ids)
+    return ttt
+
+
+def _get_pos_tag_cache_key(tokenized_text: list[str]) -> str:
+    """
+    Hashes tokenized_text along with the versions of NLTK and of the format
+    of the cache, so that tags are recomputed when the tagger may have
+    changed. Tokens never contain whitespace, so joining them with newlines
+    is unambiguous.
+    :param tokenized_text: The words of a book in sequence.
+    :return:
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        f"{POS_TAG_CACHE_FORMAT_VERSION}\n{nltk.__version__}\n".encode()
+    )
+    digest.update("\n".join(tokenized_text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Opens a temporary file next to filepath for binary writing and renames it
+# to filepath once the block completes, so that an interrupted write never
+# leaves a partial file at filepath. If the block raises, the temporary
+# file is removed instead.
+@contextlib.contextmanager
+def _atomic_write(filepath: str) -> Iterator[BinaryIO]:
+    temp_filepath = f"{filepath}.tmp"
+    try:
+        with open(temp_filepath, "wb") as file:
+            yield file
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_filepath)
+        raise
+
+
+def _process_books(
         config: dict,
-        tokenized_texts: dict[str, list[str]],
+        texts: dict[str, str],
+        compounding_dicts: dict[str, dict[str, str] | None],
         char_names: dict[str, list[str]]
-):
+) -> dict[str, ProximityStore]:
     """
-    Looks for specified character names in the associated text. When a
-    character name is found, searches in either direction for words that are
-    the correct part of speech (e.g. adjectives, adverbs - specified in
-    config file. The distance of these words from the character name are then
-    recorded.
+    Runs _process_book on every book. If the config file specifies more than
+    one worker, books are processed in parallel, each in its own process,
+    starting with the longest so that the run takes about as long as the
+    longest book.
     :param config: See the readme file for details on the config file.
-    :param tokenized_texts: A dictionary whose keys are titles and values are
-    lists of the words of the book in sequence.
+    :param texts: See _tokenize_texts.
+    :param compounding_dicts: See _tokenize_texts.
     :param char_names: A dictionary whose keys are titles and whose values
     are lists of the character names to embed.
-    :return:
+    :return: A dictionary whose keys are titles, in the same order as texts,
+    and whose values are the results of _process_book.
     """
-    # get dictionary of ttts: tagged tokenized texts
-    ttts = {
-        title: pos_tag(tokenized_text)
-        for title, tokenized_text in tokenized_texts.items()
-    }
-
     # Get parts of speech used to select words of space in which to embed
     # character names.
-    pos = config["Included Parts of Speech"]
-    if not pos:
+    if not config["Included Parts of Speech"]:
         raise ValueError(
             "No parts of speech were specified for embedding."
         )
 
-    # Create list of all words whose relationships to characters we will
-    # collect data on.
-    neighbors = list()
-    for title, ttt in ttts.items():
-        neighbors += [
-            tagged_word[0] for tagged_word in ttt
-            if (tagged_word[1] in pos)
-        ]
-    neighbors = list(set(neighbors))
-
-    # Get list of all character names in all texts:
-    all_char_names = list()
-    for title, names in char_names.items():
-        all_char_names += names
-    all_char_names = list(set(all_char_names))
-
-    # Create data structure to store proximity of neighbors to character names
-    data = {
-        name: {neighbor: list() for neighbor in neighbors}
-        for name in all_char_names
+    arguments = {
+        title: (config, title, text, compounding_dicts[title],
+                char_names[title])
+        for title, text in texts.items()
     }
+    num_workers = min(config.get("Number of Workers") or 1, len(texts))
+    if num_workers <= 1:
+        return {
+            title: _process_book(*book_arguments)
+            for title, book_arguments in arguments.items()
+        }
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            title: executor.submit(_process_book, *arguments[title])
+            for title in sorted(
+                texts,
+                key=lambda title: len(texts[title]),
+                reverse=True
+            )
+        }
+        return {title: futures[title].result() for title in texts}
+
+
+def _process_book(
+        config: dict,
+        title: str,
+        text: str,
+        compounding_dict: dict[str, str] | None,
+        char_names: list[str]
+) -> ProximityStore:
+    """
+    Tokenizes and tags a single book, then looks for the specified character
+    names in it. When a character name is found, searches in either
+    direction for words that are the correct part of speech (e.g.
+    adjectives, adverbs - specified in config file. The distance of these
+    words from the character name are then recorded.
+    :param config: See the readme file for details on the config file.
+    :param title: The title of the book.
+    :param text: The entire unprocessed text of the book.
+    :param compounding_dict: See _tokenize_texts.
+    :param char_names: The character names to embed.
+    :return: The distances found, with the character names and all the
+    words of the book that are the correct part of speech as neighbors.
+    """
+    tokenized_text = _tokenize_texts(
+        config,
+        {title: text},
+        {title: compounding_dict}
+    )[title]
+    # ttt: tagged tokenized text
+    ttt = _pos_tag_cached(
+        tokenized_text,
+        config.get("POS Tag Cache Directory")
+    )
+
+    pos = config["Included Parts of Speech"]
 
     # Get maximum distance forwards and backwards to search
     window = config["Proximity Window"]
 
-    for title, ttt in ttts.items():
-        # We will not check the relationship of other character names to our
-        # targets for embedding, and we will see if our configuration file
-        # includes other words to not embed.
-        excluded_words = char_names[title] + config["Words to Exclude"]
-
-        for i, word in enumerate(ttt):
-            # See if the word is in our local list of names. If not,
-            # we're done with this word
-            if word[0] not in char_names[title]:
-                continue
-
-            # Find the first and last index of the window
-            i_first = i - window
-            if i_first < 0:
-                i_first = 0
-            i_last = i + window
-            if i_last >= len(ttt):
-                i_last = len(ttt)-1
-
-            # Update data with the distance of neighbor words in the window
-            # from the character name, if they are an appropriate pos
-            for j in list(range(i_first, i)) + list(range(i, i_last+1)):
-                if ttt[j][1] in pos and ttt[j][0] not in excluded_words:
-                    data[word[0]][ttt[j][0]].append(
-                        (window - (abs(i-j)-1))
-                    )
+    # Encode the words and tags of the book as integer arrays, ids being
+    # given in order of first appearance.
+    vocabulary = dict()
+    word_ids = np.array(
+        [vocabulary.setdefault(word, len(vocabulary)) for word, _ in ttt],
+        dtype=np.int64
+    )
+    tagset = dict()
+    tag_ids = np.array(
+        [tagset.setdefault(tag, len(tagset)) for _, tag in ttt],
+        dtype=np.int64
+    )
+    # Whether the word at each position is an appropriate pos
+    is_pos = np.array([tag in pos for tag in tagset], dtype=bool)[tag_ids]
+
+    # Create store of the proximity of neighbors to character names, with
+    # all the words whose relationships to characters we will collect data
+    # on.
+    data = ProximityStore(window)
+    data.add_names(char_names)
+    words = list(vocabulary)
+    data.add_neighbors(sorted(
+        words[word_id] for word_id in np.unique(word_ids[is_pos]).tolist()
+    ))
+    # Ids in the store of each word in the vocabulary, -1 if it isn't a
+    # character name or a neighbor.
+    word_name_ids = np.full(len(vocabulary), -1, dtype=np.int32)
+    word_neighbor_ids = np.full(len(vocabulary), -1, dtype=np.int32)
+    for words, store_ids, word_store_ids in [
+        (char_names, data.name_ids, word_name_ids),
+        (data.neighbors, data.neighbor_ids, word_neighbor_ids)
+    ]:
+        for word in words:
+            if word in vocabulary:
+                word_store_ids[vocabulary[word]] = store_ids[word]
+
+    # We will not check the relationship of other character names to our
+    # targets for embedding, and we will see if our configuration file
+    # includes other words to not embed.
+    excluded_words = char_names + config["Words to Exclude"]
+    is_excluded = np.zeros(len(vocabulary), dtype=bool)
+    is_excluded[[vocabulary[word] for word in excluded_words
+                 if word in vocabulary]] = True
+    # Whether the word at each position is a neighbor to collect data on
+    is_neighbor = is_pos & ~is_excluded[word_ids]
+
+    # Find the positions of all our local character names at once
+    name_positions = np.flatnonzero(np.isin(
+        word_ids,
+        [vocabulary[name] for name in char_names if name in vocabulary]
+    ))
+
+    # For each offset in the window, find the neighbors at that offset from
+    # every character name. The name's own position is skipped, as names are
+    # always excluded words.
+    name_indices = list()
+    neighbor_indices = list()
+    for offset in range(-window, window + 1):
+        if offset == 0:
+            continue
+        j = name_positions + offset
+        in_text = (j >= 0) & (j < len(ttt))
+        found = in_text.copy()
+        found[in_text] = is_neighbor[j[in_text]]
+        name_indices.append(name_positions[found])
+        neighbor_indices.append(j[found])
+    i = np.concatenate(name_indices) if name_indices else name_positions[:0]
+    j = np.concatenate(neighbor_indices) if neighbor_indices else i
+
+    # Record the distances of the neighbors from each character name in the
+    # order of the text
+    order = np.lexsort((j, i))
+    i = i[order]
+    j = j[order]
+    data.add(
+        word_name_ids[word_ids[i]],
+        word_neighbor_ids[word_ids[j]],
+        window - (np.abs(i - j) - 1)
+    )
+    return data
+
+
+def _process_texts(
+        config: dict,
+        book_data: dict[str, ProximityStore]
+):
+    """
+    Merges the data on the proximity of words to character names of each
+    book, and saves it. The distances of a neighbor word from a character
+    name are listed in the order of the books, so the result doesn't depend
+    on the order in which the books were processed.
+    :param config: See the readme file for details on the config file.
+    :param book_data: A dictionary whose keys are titles and whose values are
+    the results of _process_book.
+    :return:
+    """
+    output_format = config.get("Output Format", "lists")
+    if output_format not in ("lists", "sparse"):
+        raise ValueError(
+            f"Output format {output_format} should be 'lists' or 'sparse'."
+        )
+
+    data = ProximityStore(config["Proximity Window"])
+    for title, book_store in book_data.items():
+        data.merge(book_store)
 
     # Save data
     output_directory = config["Output Directory"]
@@ -353,15 +835,232 @@ def _process_texts(
             f"Input directory {output_directory} not found."
         )
 
-    # Save results as json file in output directory
+    # Save results in output directory
     file_path = os.path.join(
         output_directory,
         f"{config['Output File Name']}, "
         f"{pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')}"
-        f".json"
     )
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4, sort_keys=True, ensure_ascii=False)
+    if output_format == "sparse":
+        data.save(f"{file_path}.npz")
+        return
+    with open(f"{file_path}.json", 'w') as file:
+        _write_distance_lists(file, data)
+
+
+def _write_distance_lists(file, data: ProximityStore):
+    """
+    Writes the lists of distances of every neighbor word from every
+    character name as json, exactly as json.dump(..., indent=4,
+    sort_keys=True, ensure_ascii=False) would write a dictionary whose keys
+    are character names and whose values are dictionaries of the distances
+    of each neighbor word, one character name at a time, so that the
+    dictionaries of all character names are never all held in memory.
+    :param file: The file to write to.
+    :param data: The store of the distances.
+    :return:
+    """
+    file.write("{")
+    for i, (name, distance_lists) in enumerate(data.iter_distance_lists()):
+        name_json = json.dumps(
+            distance_lists,
+            indent=4,
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        file.write(
+            f"{',' if i else ''}\n    "
+            f"{json.dumps(name, ensure_ascii=False)}: "
+            + name_json.replace("\n", "\n    ")
+        )
+    file.write("\n}" if data.names else "}")
+
+
+class ProximityStore:
+    """
+    Sparse store of the distances of neighbor words from character names.
+    Rather than keeping a list for every pair of a character name and a
+    neighbor word, most of which stay empty, each distance found is stored
+    as a row of typed arrays of name ids, neighbor ids and distances, so that
+    memory grows with the number of distances found rather than with the
+    number of names times the number of neighbors.
+    aggregate reduces the distances to statistics for each pair that was
+    found, and iter_distance_lists gives the lists of distances written in
+    the lists output format.
+    :param window: The proximity window the distances were found with. As
+    recorded by _process_book, distances range from 1, for words window
+    positions away from the name, to window, for adjacent words.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.names = list()
+        self.name_ids = dict()
+        self.neighbors = list()
+        self.neighbor_ids = dict()
+        self._name_id_chunks = list()
+        self._neighbor_id_chunks = list()
+        self._distance_chunks = list()
+
+    def add_names(self, names: Iterable[str]) -> np.ndarray:
+        """
+        Adds character names that aren't in the store yet.
+        :return: The ids of names.
+        """
+        return _add_ids(names, self.names, self.name_ids)
+
+    def add_neighbors(self, neighbors: Iterable[str]) -> np.ndarray:
+        """
+        Adds neighbor words that aren't in the store yet.
+        :return: The ids of neighbors.
+        """
+        return _add_ids(neighbors, self.neighbors, self.neighbor_ids)
+
+    def add(
+            self,
+            name_ids: Iterable[int],
+            neighbor_ids: Iterable[int],
+            distances: Iterable[int]
+    ):
+        """
+        Records distances of neighbor words from character names, in the
+        order they were found.
+        :param name_ids: The id of the character name of each distance.
+        :param neighbor_ids: The id of the neighbor word of each distance.
+        :param distances: The distances.
+        :return:
+        """
+        self._name_id_chunks.append(np.asarray(name_ids, dtype=np.int32))
+        self._neighbor_id_chunks.append(
+            np.asarray(neighbor_ids, dtype=np.int32)
+        )
+        self._distance_chunks.append(
+            np.asarray(distances, dtype=np.min_scalar_type(self.window + 1))
+        )
+
+    def merge(self, other: ProximityStore):
+        """
+        Adds the names, neighbors and distances of other to this store, the
+        distances of other being recorded after those of this store.
+        :param other: A store with the same window.
+        :return:
+        """
+        if other.window != self.window:
+            raise ValueError(
+                f"Can't merge proximity data found with a window of "
+                f"{other.window} into data found with a window of "
+                f"{self.window}."
+            )
+        name_ids = self.add_names(other.names)
+        neighbor_ids = self.add_neighbors(other.neighbors)
+        other_name_ids, other_neighbor_ids, distances = \
+            other.get_distances()
+        self.add(
+            name_ids[other_name_ids],
+            neighbor_ids[other_neighbor_ids],
+            distances
+        )
+
+    def get_distances(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: The name ids, neighbor ids and distances recorded so far,
+        in the order they were found.
+        """
+        if not self._distance_chunks:
+            self.add([], [], [])
+        # Concatenate once, so later calls don't copy the arrays again.
+        self._name_id_chunks = [np.concatenate(self._name_id_chunks)]
+        self._neighbor_id_chunks = [np.concatenate(self._neighbor_id_chunks)]
+        self._distance_chunks = [np.concatenate(self._distance_chunks)]
+        return (
+            self._name_id_chunks[0],
+            self._neighbor_id_chunks[0],
+            self._distance_chunks[0]
+        )
+
+    def aggregate(self) -> dict[str, np.ndarray]:
+        """
+        Reduces the distances to statistics for each pair of a character
+        name and a neighbor word that was found.
+        :return: A dictionary of arrays with one entry per pair: the
+        "name_ids" and "neighbor_ids" of the pairs, ordered by name then
+        neighbor id, the number of distances of each pair ("counts"), their
+        sum ("distance_sums"), and "histograms", whose column d is the number
+        of times each pair was found at distance d.
+        """
+        name_ids, neighbor_ids, distances = self.get_distances()
+        keys = (name_ids.astype(np.int64) * len(self.neighbors)
+                + neighbor_ids)
+        keys, pairs = np.unique(keys, return_inverse=True)
+        num_bins = self.window + 1
+        return {
+            "name_ids": (keys // max(len(self.neighbors), 1))
+            .astype(np.int32),
+            "neighbor_ids": (keys % max(len(self.neighbors), 1))
+            .astype(np.int32),
+            "counts": np.bincount(pairs, minlength=len(keys)),
+            "distance_sums": np.bincount(
+                pairs,
+                weights=distances,
+                minlength=len(keys)
+            ).astype(np.int64),
+            "histograms": np.bincount(
+                pairs * num_bins + distances,
+                minlength=len(keys) * num_bins
+            ).reshape(len(keys), num_bins).astype(np.int32)
+        }
+
+    def iter_distance_lists(self) -> Iterable[tuple[str, dict[str, list]]]:
+        """
+        Iterates over the character names in sorted order, giving for each
+        the list of distances of every neighbor word from it, in the order
+        they were found, with empty lists for neighbors never found near it.
+        """
+        name_ids, neighbor_ids, distances = self.get_distances()
+        order = np.argsort(name_ids, kind="stable")
+        boundaries = np.searchsorted(
+            name_ids[order],
+            np.arange(len(self.names) + 1)
+        )
+        for name in sorted(self.names):
+            name_id = self.name_ids[name]
+            rows = order[boundaries[name_id]:boundaries[name_id + 1]]
+            distance_lists = {neighbor: list() for neighbor in self.neighbors}
+            for neighbor_id, distance in zip(
+                    neighbor_ids[rows].tolist(),
+                    distances[rows].tolist()
+            ):
+                distance_lists[self.neighbors[neighbor_id]].append(distance)
+            yield name, distance_lists
+
+    def save(self, filepath: str):
+        """
+        Saves the character names, neighbor words and the statistics of each
+        pair returned by aggregate as a .npz file, along with the window.
+        :param filepath: The path of the file, ending in '.npz'.
+        :return:
+        """
+        np.savez_compressed(
+            filepath,
+            window=np.array(self.window),
+            names=np.array(self.names, dtype=str),
+            neighbors=np.array(self.neighbors, dtype=str),
+            **self.aggregate()
+        )
+
+
+def _add_ids(
+        tokens: Iterable[str],
+        id2token: list[str],
+        token2id: dict[str, int]
+) -> np.ndarray:
+    ids = list()
+    for token in tokens:
+        if token not in token2id:
+            token2id[token] = len(id2token)
+            id2token.append(token)
+        ids.append(token2id[token])
+    return np.array(ids, dtype=np.int32)
 
 
 if __name__ == '__main__':